@@ -3,19 +3,29 @@ from glob import glob
 from socket import gethostname
 from uuid import uuid4 as uuid
 import collections
+import csv
+import datetime
+import base64
 import ConfigParser
 import email
+import errno
 import getpass
 import hashlib
+import json
+import heapq
 import logging
 import mailbox
+import mmap
+import multiprocessing.pool
 import optparse
 import os
+import quopri
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
 try:
     from cStringIO import StringIO
@@ -78,6 +88,8 @@ else:
     DEFAULT_SYSTEM_DIR = "/etc"
 DEFAULT_USER_CONFIG = os.path.join(DEFAULT_USER_DIR, "config.ini")
 DEFAULT_SYSTEM_CONFIG = os.path.join(DEFAULT_SYSTEM_DIR, "%s.ini" % APP_NAME)
+# next to the todo directory, overriding the system/user config
+REPO_CONFIG = ".%s.ini" % APP_NAME
 
 ##################################################
 # defaults
@@ -110,6 +122,81 @@ PRIORITY_STRING = ', '.join(
 
 CONTENT_PREFIX_TO_IGNORE = "#" + APP_NAME
 
+# per-todo-dir cache/state files live in here
+STATE_DIRNAME = "." + APP_NAME
+CACHE_VERSION = 3
+SCAN_CACHE = "scan.cache"
+DEF_JOBS = 8
+# how long before a lock taken on another host is assumed abandoned
+LOCK_STALE_SECONDS = 10 * 60
+# how long before a folded stats journal can't still be written to
+JOURNAL_SETTLE_SECONDS = 60
+STATS_STATE = "stats.state"
+STATS_JOURNAL = "stats.journal"
+STATS_LOCK = "stats.lock"
+STATS_CATEGORY = "category"
+STATS_PRIORITY = "priority"
+STATS_AUTHOR = "author"
+STATS_WEEK = "week"
+STATS_CLOSED = "closed"
+STATS_DIMENSIONS = [
+    STATS_CATEGORY,
+    STATS_PRIORITY,
+    STATS_AUTHOR,
+    STATS_WEEK,
+    STATS_CLOSED,
+    ]
+STATS_FORMATS = ["json", "csv"]
+COMPLETE_CACHE = "complete"
+COMPLETE_CMD = "cmd"
+COMPLETE_CATEGORY = "category"
+COMPLETE_PRIORITY = "priority"
+COMPLETE_DIMENSION = "dimension"
+COMPLETE_ITEM = "item"
+COMPLETE_SHELLS = ["bash", "zsh"]
+# appended lines may grow the cache this much (or by as much as it
+# was when rebuilt, if that's more) before it gets compacted
+COMPLETE_SLACK = 16 * 1024
+STAGE_JOURNAL = "stage.journal"
+STAGE_LOCK = "stage.lock"
+# how far into stage.journal.draining has been staged
+STAGE_OFFSET = "stage.offset"
+# an append to the journal is a single write just after opening
+# it, so this is plenty for one that raced the rename to finish
+STAGE_SETTLE_SECONDS = 2
+STAGING_IMMEDIATE = "immediate"
+STAGING_JOURNAL = "journal"
+STAGING_BACKGROUND = "background"
+STAGING_MODES = [
+    STAGING_IMMEDIATE,
+    STAGING_JOURNAL,
+    STAGING_BACKGROUND,
+    ]
+DEF_STAGING = STAGING_IMMEDIATE
+QUEUE_STATE = "queue.state"
+QUEUE_JOURNAL = "queue.journal"
+QUEUE_LOCK = "queue.lock"
+# stale heap entries allowed (beyond one per item) before compacting
+QUEUE_SLACK = 1024
+CLAIMS_DIRNAME = "claims"
+DEF_LEASE_SECONDS = 60 * 60
+DISCOVERY_CACHE = os.path.join(DEFAULT_USER_DIR, "discovery.cache")
+DISCOVERY_LIMIT = 64
+# the things get_vcs() looks for
+VCS_DIRNAMES = [".git", ".hg", ".bzr"]
+SHOW_CACHE_DIRNAME = "show"
+SHOW_CACHE_LIMIT = 256
+# the most of an item copied out of its mmap at once
+SHOW_CHUNK = 64 * 1024
+SHOW_HEADERS = [
+    "From",
+    "Date",
+    "Subject",
+    "X-Priority",
+    "X-Revision",
+    "X-Closed",
+    ]
+
 DEF_VCS = VCS_AUTO = "auto"
 
 ##################################################
@@ -123,18 +210,44 @@ CONF_PENDING_CATEGORIES = "pending_categories"
 CONF_USERNAME = "name"
 CONF_EDITOR = "editor"
 CONF_VCS = "vcs"
+CONF_JOBS = "jobs"
+CONF_STAGING = "staging"
+# the only settings a (committed) REPO_CONFIG may change
+REPO_CONFIG_KEYS = [
+    CONF_PENDING_CATEGORIES,
+    CONF_DONE_CATEGORY,
+    CONF_JOBS,
+    CONF_STAGING,
+    ]
+CONF_SEC_ROOTS = "roots"
 
 ##################################################
 # parser constants
 ##################################################
 OPT_CONFIG = "config"
+OPT_ALL_ROOTS = "all_roots"
+OPT_AT = "at"
 OPT_ATTACHMENTS = "attachments"
+OPT_BATCH = "batch"
+OPT_CATEGORY = "category"
 OPT_EMAIL = "email"
+OPT_FORMAT = "format"
 OPT_PRIORITY = "priority"
+OPT_RANGE = "range"
 OPT_GATHER_MESSAGE = "gather_message"
+OPT_HEAD = "head"
+OPT_LEASE = "lease"
+OPT_HEADERS = "headers"
+OPT_REFRESH = "refresh"
+OPT_REINDEX = "reindex"
+OPT_RELEASE = "release"
 OPT_REVISION = "revision"
+OPT_SCRIPT = "script"
+OPT_TAIL = "tail"
+OPT_ROOTS = "roots"
 OPT_USERNAME = "username"
 OPT_VERBOSE = "verbose"
+OPT_WORKER = "worker"
 
 ##################################################
 # parser commands
@@ -149,6 +262,10 @@ CMD_SHOW = "show"
 CMD_COMMENT = "comment"
 CMD_LIST = "list"
 CMD_SEARCH = "search"
+CMD_STATS = "stats"
+CMD_COMPLETE = "complete"
+CMD_SYNC = "sync"
+CMD_NEXT = "next"
 CMD_DUMP_CONFIG = "dump-config"
 
 ##################################################
@@ -161,6 +278,52 @@ HEAD_REFERENCES = "References"
 HEAD_MSG_ID = "Message-ID"
 HEAD_PRIORITY = "X-Priority"
 HEAD_REVISION = "X-Revision"
+HEAD_CLOSED = "X-Closed"
+HEADER_NAME_RE = r"[A-Za-z][-\w]*"
+
+##################################################
+# shell completion
+##################################################
+COMPLETION_SCRIPT = """\
+_%(app)s_complete() {
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local prev="${COMP_WORDS[COMP_CWORD-1]}"
+    local dir="$PWD" cache="" cmd="" kinds="" i
+    while :; do
+        if [ -f "$dir/%(dirname)s/%(state)s/%(cache)s" ]; then
+            cache="$dir/%(dirname)s/%(state)s/%(cache)s"
+            break
+        fi
+        [ -z "$dir" ] && break
+        dir="${dir%%/*}"
+    done
+    if [ -z "$cache" ]; then
+        COMPREPLY=($(%(app)s %(complete)s -- "${COMP_WORDS[@]:1:COMP_CWORD}"))
+        return
+    fi
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i-1]}" in -c|--config|-R|--root) continue ;; esac
+        case "${COMP_WORDS[i]}" in -*) ;; *) cmd="${COMP_WORDS[i]}"; break ;; esac
+    done
+    case "$prev" in
+        -p|--priority) kinds="%(priority)s" ;;
+        *)
+            case "$cmd" in
+                ""|%(help)s) kinds="%(cmd)s" ;;
+                %(add)s) kinds="%(category)s" ;;
+                %(stats)s) kinds="%(dimension)s" ;;
+                *) kinds="%(category)s %(item)s" ;;
+            esac ;;
+    esac
+    COMPREPLY=($(awk -F '\t' -v kinds=" $kinds " -v cur="$cur" \\
+        'index(kinds, " " $1 " ") && index($2, cur) == 1 && !seen[$2]++ { print $2 }' \\
+        "$cache"))
+}
+complete -F _%(app)s_complete %(app)s
+"""
+ZSH_COMPLETION_PREFIX = """\
+autoload -U +X bashcompinit && bashcompinit
+"""
 
 ##################################################
 # helper functions
@@ -234,21 +397,30 @@ def edit(editor, s=""):
 def short_desc(fn):
     return getattr(fn, "__doc__", "<undefined>").splitlines()[0]
 
-def find_dir(dirname, create=False, _result_cache={}):
-    """Walks up from the current directory to find 'dirname'
-    If 'dirname' can't be found, create such a directory in
-    the current directory
+# find_dir() results, keyed by (start, dirname)
+FIND_DIR_CACHE = {}
+
+def find_dir(dirname, create=False, start=None,
+        _result_cache=FIND_DIR_CACHE):
+    """Walks up from 'start' (default: the current directory)
+    to find 'dirname'.  If 'dirname' can't be found, create
+    such a directory in 'start'
     """
-    if dirname in _result_cache:
-        return _result_cache[dirname]
-    cwd = last = loc = os.getcwd()
+    if start is None:
+        start = os.getcwd()
+    start = os.path.abspath(start)
+    if (start, dirname) in _result_cache and (
+            _result_cache[(start, dirname)] is not None or not create):
+        # (a remembered miss from a discovery snapshot)
+        return _result_cache[(start, dirname)]
+    cwd = last = loc = start
     while not os.path.isdir(os.path.join(loc, dirname)):
         loc, _ = os.path.split(loc)
         if loc == last:
             # we've walked up to the root
             if create:
                 log.info("Creating %s", os.path.join(cwd, dirname))
-                os.mkdir(dirname)
+                os.mkdir(os.path.join(cwd, dirname))
                 loc = cwd
                 break
             else:
@@ -258,12 +430,242 @@ def find_dir(dirname, create=False, _result_cache={}):
         if loc != cwd:
             log.info("Walked up to find %s in %s", dirname, loc)
     results = os.path.join(loc, dirname)
-    _result_cache[dirname] = results
+    _result_cache[(start, dirname)] = results
     return results
 
-def find_dir_based_on_config(config, create=True):
+def find_dir_based_on_config(config, create=True, start=None):
     dirname = config.get(CONF_SEC_CONFIG, CONF_DIRNAME)
-    return find_dir(dirname, create=create)
+    return find_dir(dirname, create=create, start=start)
+
+def state_file(todo_dir, name):
+    "The location of the cache/state file 'name' for 'todo_dir'"
+    return os.path.join(todo_dir, STATE_DIRNAME, name)
+
+def make_state_dir(todo_dir):
+    """Create the state directory for 'todo_dir' if needed,
+    telling it to keep itself out of version control
+    """
+    dest_dir = os.path.join(todo_dir, STATE_DIRNAME)
+    if not os.path.isdir(dest_dir):
+        try:
+            os.mkdir(dest_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        f = file(os.path.join(dest_dir, ".gitignore"), "w")
+        try:
+            f.write("*\n")
+        finally:
+            f.close()
+    return dest_dir
+
+def append_state(todo_dir, name, lines, sync=False):
+    """Append 'lines' to the state file 'name' with one O_APPEND
+    write, so concurrent writers don't need a lock.  With
+    'sync', don't return until they're on stable storage
+    """
+    state_dir = make_state_dir(todo_dir)
+    fname = state_file(todo_dir, name)
+    created = sync and not os.path.exists(fname)
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    try:
+        os.write(fd, ''.join(lines))
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    if created:
+        fsync_paths([state_dir])
+
+def create_exclusive(fname, content):
+    """Create 'fname' holding 'content', unless it already exists
+    The content goes into a temp file which is then linked
+    into place, so nobody ever sees the file partly written.
+    Returns whether 'fname' was created
+    """
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=".%s-" % APP_NAME,
+        suffix=".tmp",
+        dir=os.path.dirname(fname),
+        )
+    try:
+        try:
+            os.write(fd, content)
+        finally:
+            os.close(fd)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_name, 0666 & ~umask)
+        try:
+            if hasattr(os, "link"):
+                os.link(tmp_name, fname)
+            else:
+                # win32 refuses to rename over an existing file
+                os.rename(tmp_name, fname)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+def lock_is_stale(lock_name):
+    """Whether the lock file 'lock_name' was left behind by a crash
+    Locks from this host are stale once their process is gone.
+    There's no telling for other hosts, so theirs are stale
+    once older than LOCK_STALE_SECONDS
+    """
+    try:
+        f = file(lock_name)
+        try:
+            owner = f.read().split()
+        finally:
+            f.close()
+        age = time.time() - os.stat(lock_name).st_mtime
+    except (IOError, OSError):
+        # already gone, try again later
+        return False
+    if len(owner) == 2 and owner[0] == gethostname() and not IS_WINDOWS:
+        try:
+            os.kill(int(owner[1]), 0)
+        except ValueError:
+            pass
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        else:
+            return False
+    return age > LOCK_STALE_SECONDS
+
+def try_lock(todo_dir, name):
+    """Try to take the exclusive lock file 'name' without waiting
+    Locks left behind by a crash (see lock_is_stale()) are broken
+    """
+    make_state_dir(todo_dir)
+    lock_name = state_file(todo_dir, name)
+    owner = "%s %i\n" % (gethostname(), os.getpid())
+    if create_exclusive(lock_name, owner):
+        return True
+    if not lock_is_stale(lock_name):
+        return False
+    log.warning("Breaking stale lock %s", lock_name)
+    try:
+        os.remove(lock_name)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return create_exclusive(lock_name, owner)
+
+def unlock(todo_dir, name):
+    os.remove(state_file(todo_dir, name))
+
+def _to_text(data):
+    """Turn the byte strings in 'data' into unicode for JSON
+    latin-1 maps every byte, so nothing is lost either way
+    """
+    if isinstance(data, str):
+        return data.decode("latin-1")
+    if isinstance(data, (list, tuple)):
+        return [_to_text(item) for item in data]
+    if isinstance(data, dict):
+        return dict(
+            (_to_text(key), _to_text(value))
+            for key, value in data.iteritems()
+            )
+    return data
+
+def _from_text(data):
+    "Undo _to_text()"
+    if isinstance(data, unicode):
+        return data.encode("latin-1")
+    if isinstance(data, list):
+        return [_from_text(item) for item in data]
+    if isinstance(data, dict):
+        return dict(
+            (_from_text(key), _from_text(value))
+            for key, value in data.iteritems()
+            )
+    return data
+
+def load_cache(fname, default=None, check=None):
+    """Load a JSON cache file
+    Missing, unreadable, corrupt or outdated files, or ones
+    whose data 'check' doesn't accept, give 'default'.  Only
+    plain data is ever loaded, so caches in other people's
+    trees can't run code
+    """
+    try:
+        f = file(fname, "rb")
+        try:
+            raw = json.load(f)
+        finally:
+            f.close()
+    except Exception, e:
+        log.debug("No usable %s: %s", fname, e)
+        return default
+    if not isinstance(raw, dict) or raw.get("version") != CACHE_VERSION:
+        log.debug("Outdated %s", fname)
+        return default
+    data = _from_text(raw.get("data"))
+    if check is not None:
+        try:
+            ok = check(data)
+        except Exception, e:
+            ok = False
+        if not ok:
+            log.warning("Ignoring malformed %s", fname)
+            return default
+    return data
+
+def save_cache(fname, data):
+    "Atomically replace the JSON cache file 'fname'"
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=os.path.basename(fname),
+        dir=os.path.dirname(fname),
+        )
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            json.dump(
+                {"version": CACHE_VERSION, "data": _to_text(data)},
+                f,
+                separators=(",", ":"),
+                )
+        finally:
+            f.close()
+        if IS_WINDOWS and os.path.exists(fname):
+            os.remove(fname)
+        os.rename(tmp_name, fname)
+    except:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def load_state(todo_dir, name, default=None, check=None):
+    "Load the cache/state file 'name' for 'todo_dir'"
+    return load_cache(state_file(todo_dir, name), default, check)
+
+def save_state(todo_dir, name, data):
+    """Atomically replace the state file 'name'
+    The state directory is created on demand, and told to
+    keep itself out of version control
+    """
+    make_state_dir(todo_dir)
+    save_cache(state_file(todo_dir, name), data)
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(
+        value, bool)
+
+def list_categories(todo_dir):
+    "Return the names of the category directories in 'todo_dir'"
+    return sorted(
+        name
+        for name in os.listdir(todo_dir)
+        if not name.startswith('.')
+        and os.path.isdir(os.path.join(todo_dir, name))
+        )
 
 def find_or_create_category_dir(todo_dir, category):
     """Look in 'todo_dir' for a directory named 'category'
@@ -359,6 +761,1071 @@ def build_item(
     msg.set_unixfrom(user_string)
     return msg
 
+def read_headers(fname):
+    """Parse just the header block of the first message in 'fname'
+    The body is never read, so this is cheap even for huge items
+    """
+    f = file(fname, "rb")
+    try:
+        return headers_from_lines(f)
+    finally:
+        f.close()
+
+def headers_from_lines(lines):
+    """Parse the header block from an iterable of mbox 'lines'
+    Nothing past the blank line ending the headers is consumed
+    """
+    header_lines = []
+    for line in lines:
+        if not header_lines and line.startswith("From "):
+            # skip the mbox envelope line
+            continue
+        if not line.rstrip("\r\n"):
+            break
+        header_lines.append(line)
+    return email.message_from_string(''.join(header_lines))
+
+def rewrite_headers(fname, changes):
+    """Rewrite the header block of the first message in 'fname'
+    'changes' is a list of (header, value) pairs.  Existing
+    headers are replaced in place, new ones are appended and
+    a value of None removes the header.  The rest of the file
+    is streamed into a temp file which is renamed over 'fname'
+    """
+    wanted = collections.OrderedDict(
+        (name.lower(), (name, value))
+        for name, value in changes
+        )
+    dest_dir = os.path.dirname(os.path.abspath(fname))
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=".%s-" % APP_NAME,
+        suffix=".tmp",
+        dir=dest_dir,
+        )
+    try:
+        dst = os.fdopen(fd, "wb")
+        try:
+            src = file(fname, "rb")
+            try:
+                line = src.readline()
+                if line.startswith("From "):
+                    dst.write(line)
+                    line = src.readline()
+                headers = [] # [name, raw text including continuations]
+                while line and line.rstrip("\r\n"):
+                    if line[0] in " \t" and headers:
+                        headers[-1][1] += line
+                    else:
+                        headers.append([line.split(":", 1)[0].strip(), line])
+                    line = src.readline()
+                written = set()
+                for name, raw in headers:
+                    key = name.lower()
+                    if key in wanted:
+                        if key not in written:
+                            written.add(key)
+                            new_name, value = wanted[key]
+                            if value is not None:
+                                dst.write("%s: %s\n" % (new_name, value))
+                    else:
+                        dst.write(raw)
+                for key, (name, value) in wanted.iteritems():
+                    if key not in written and value is not None:
+                        dst.write("%s: %s\n" % (name, value))
+                # the blank separator line (if any) and the body
+                dst.write(line)
+                shutil.copyfileobj(src, dst)
+            finally:
+                src.close()
+            dst.flush()
+            os.fsync(dst.fileno())
+        finally:
+            dst.close()
+        shutil.copymode(fname, tmp_name)
+        if IS_WINDOWS:
+            # can't rename over an existing file
+            os.remove(fname)
+        os.rename(tmp_name, fname)
+    except:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def stage_item(dest_dir, item):
+    """Write 'item' as a new mbox in a private temp file in 'dest_dir'
+    Nobody else can see the file, so no locking is needed.  It
+    is written straight through a plain file (mailbox.mbox would
+    fsync it), leaving the caller to fsync a whole batch at once.
+    Returns the name of the temp file for publish_item()
+    """
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=".%s-" % APP_NAME,
+        suffix=".tmp",
+        dir=dest_dir,
+        )
+    try:
+        # mkstemp() is always 0600, use what open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_name, 0666 & ~umask)
+        # the same layout mailbox.mbox.add() writes
+        content = "From %s\n%s" % (item.get_from(), item.as_string())
+        if not content.endswith("\n"):
+            content += "\n"
+        f = os.fdopen(fd, "wb")
+        fd = None
+        try:
+            f.write(content + "\n")
+        finally:
+            f.close()
+    except:
+        if fd is not None:
+            os.close(fd)
+        os.remove(tmp_name)
+        raise
+    return tmp_name
+
+def fsync_paths(paths):
+    "Flush the given files (or directories) to stable storage"
+    for path in paths:
+        if IS_WINDOWS and os.path.isdir(path):
+            # can't open directories on win32
+            continue
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def publish_item(tmp_name, dest_dir, subject):
+    """Atomically give a staged item its final name in 'dest_dir'
+    Hard-linking fails rather than clobbering an existing file
+    (even over NFS), in which case another name is tried.
+    Returns the final name
+    """
+    while True:
+        fname = transform_subject_to_filename(subject) + ".mbox"
+        full_fname = os.path.join(dest_dir, fname)
+        try:
+            if hasattr(os, "link"):
+                os.link(tmp_name, full_fname)
+            else:
+                # win32 refuses to rename over an existing file
+                os.rename(tmp_name, full_fname)
+                return full_fname
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            # NFS can retry a link() that worked and report EEXIST,
+            # in which case the temp file has gained a second name
+            if os.stat(tmp_name).st_nlink < 2:
+                log.debug("%r already exists, trying another name",
+                    full_fname)
+                continue
+        os.remove(tmp_name)
+        return full_fname
+
+def parse_query(terms, categories):
+    """Split query 'terms' into (categories, headers, words)
+    Terms of the form "Header:value" or "Header=value" must
+    match that header exactly (see header_matches()), terms
+    naming a category restrict the results to that category,
+    and anything else has to appear in the subject or the
+    filename
+    """
+    known = dict((clean(name), name) for name in categories)
+    query_categories = set()
+    headers = []
+    words = []
+    for term in terms:
+        m = re.match(r"^(%s)[:=](.*)$" % HEADER_NAME_RE, term)
+        if m:
+            headers.append((m.group(1), clean(m.group(2))))
+        elif clean(term) in known:
+            query_categories.add(known[clean(term)])
+        else:
+            words.append(clean(term))
+    return query_categories, headers, words
+
+def header_matches(name, wanted, actual):
+    """Check a "Header:value" query term against a header
+    Priorities match by number or name ("high" is not
+    "highest"), addresses by the whole value, the name or the
+    address, and anything else by the whole (cleaned) value
+    """
+    actual = clean(actual)
+    if clean(name) == clean(HEAD_PRIORITY):
+        m = re.match(r"\s*(\d+)", actual)
+        if not m:
+            return False
+        if wanted in PRIORITY_NAME_TO_NUMBER:
+            return int(m.group(1)) == PRIORITY_NAME_TO_NUMBER[wanted]
+        return wanted.isdigit() and int(wanted) == int(m.group(1))
+    if wanted == actual:
+        return True
+    if clean(name) in ("from", "to", "cc", "reply-to"):
+        user, address = email.utils.parseaddr(actual)
+        return wanted in (clean(user), clean(address))
+    return False
+
+def item_matches(fname, query, msg=None):
+    """Check whether the item in 'fname' satisfies a parse_query() result
+    'msg' may supply already-parsed headers for the item
+    """
+    categories, headers, words = query
+    if categories:
+        category = os.path.basename(os.path.dirname(fname))
+        if category not in categories:
+            return False
+    if not (headers or words):
+        return True
+    if msg is None:
+        msg = read_headers(fname)
+    for name, value in headers:
+        if not header_matches(name, value, msg.get(name, "")):
+            return False
+    haystack = clean("%s %s" % (
+        msg.get(HEAD_SUBJECT, ""),
+        os.path.basename(fname),
+        ))
+    for word in words:
+        if word not in haystack:
+            return False
+    return True
+
+def item_sort_key(msg):
+    "Sort by priority (highest first), then by date (oldest first)"
+    m = re.match(r"\s*(\d+)", msg.get(HEAD_PRIORITY, ""))
+    priority = m and int(m.group(1)) or DEF_PRIORITY_NUM
+    date = email.utils.parsedate_tz(msg.get(HEAD_DATE, ""))
+    when = date and email.utils.mktime_tz(date) or 0
+    return priority, when
+
+def valid_scan_cache(entries):
+    "Check the shape of the scan cache: {relname: [mtime, size, headers]}"
+    return isinstance(entries, dict) and all(
+        isinstance(relname, str)
+        and isinstance(entry, list)
+        and len(entry) == 3
+        and is_number(entry[0])
+        and is_number(entry[1])
+        and isinstance(entry[2], str)
+        for relname, entry in entries.iteritems()
+        )
+
+def scan_todo_dir(todo_dir):
+    """Return [(sort key, category, fname, headers)] for every item
+    The raw header blocks are cached in the state directory
+    and only re-read for items whose mtime/size changed
+    """
+    entries = load_state(todo_dir, SCAN_CACHE, {}, valid_scan_cache)
+    new_entries = {}
+    for category in list_categories(todo_dir):
+        for fname in glob(os.path.join(todo_dir, category, "*mbox")):
+            relname = os.path.join(category, os.path.basename(fname))
+            try:
+                st = os.stat(fname)
+            except OSError:
+                # moved away since the glob
+                continue
+            entry = entries.get(relname)
+            if entry is None or entry[:2] != [st.st_mtime, st.st_size]:
+                log.debug("Reading headers of %s", relname)
+                headers = read_headers(fname).as_string()
+                entry = [st.st_mtime, st.st_size, headers]
+            new_entries[relname] = entry
+    if new_entries != entries:
+        try:
+            save_state(todo_dir, SCAN_CACHE, new_entries)
+        except (IOError, OSError), e:
+            log.warning("Can't cache scan of %s: %s", todo_dir, e)
+    results = []
+    for relname, (_, _, headers) in new_entries.iteritems():
+        msg = email.message_from_string(headers)
+        results.append((
+            item_sort_key(msg),
+            os.path.dirname(relname),
+            os.path.join(todo_dir, relname),
+            msg,
+            ))
+    return results
+
+def items_at(vcs, todo_dir, rev):
+    "The names of the items under 'todo_dir' as of 'rev'"
+    results = []
+    for fname in vcs.list_files_at(rev, todo_dir):
+        category, name = os.path.split(os.path.relpath(fname, todo_dir))
+        if (category
+                and os.sep not in category
+                and not category.startswith('.')
+                and name.endswith("mbox")):
+            results.append(os.path.join(todo_dir, category, name))
+    return results
+
+def scan_todo_dir_at(config, todo_dir, rev):
+    """Like scan_todo_dir(), but as of revision 'rev', reading
+    the headers straight out of the VCS rather than a checkout
+    """
+    vcs = get_vcs(config, todo_dir)
+    return [
+        (
+            item_sort_key(msg),
+            os.path.basename(os.path.dirname(fname)),
+            fname,
+            msg,
+            )
+        for fname, msg in vcs.iter_headers_at(
+            rev, items_at(vcs, todo_dir, rev))
+        ]
+
+def existing_dir(fname):
+    """The nearest directory above 'fname' in the checkout
+    (items of an old revision may be in directories since removed)
+    """
+    dirname = os.path.dirname(fname)
+    while not os.path.isdir(dirname):
+        dirname = os.path.dirname(dirname)
+    return dirname
+
+def categories_of(items):
+    "The categories of 'items' as returned by scan_todo_dir_at()"
+    return sorted(set(category for _, category, _, _ in items))
+
+def search_root(config, root, terms, include_done=True, rev=None,
+        strict=True):
+    """Return the sorted [(sort key, fname)] of matching items
+    in the todo directory of 'root' (None for the one found
+    from the current directory, which is created if need be),
+    as of revision 'rev' if given.  Unless 'strict', a root
+    which can't be read as of 'rev' is logged and skipped
+    """
+    if root is None:
+        todo_dir = find_dir_based_on_config(config)
+    else:
+        # no walking up: a root without a todo directory would
+        # find its parent's, which other roots may share
+        todo_dir = os.path.join(
+            root, config.get(CONF_SEC_CONFIG, CONF_DIRNAME))
+        if not os.path.isdir(todo_dir):
+            log.info("No %s directory in %s", APP_NAME, root)
+            return []
+    done_category = config.get(CONF_SEC_CONFIG, CONF_DONE_CATEGORY)
+    if rev is None:
+        items = scan_todo_dir(todo_dir)
+        query = parse_query(terms, list_categories(todo_dir))
+    else:
+        try:
+            items = scan_todo_dir_at(config, todo_dir, rev)
+        except (ValueError, NotImplementedError, OSError), e:
+            if strict:
+                raise
+            log.warning("Skipping %s: %s", todo_dir, e)
+            return []
+        query = parse_query(terms, categories_of(items))
+    results = [
+        (key, fname)
+        for key, category, fname, msg in items
+        if (include_done or category != done_category)
+        and item_matches(fname, query, msg)
+        ]
+    results.sort()
+    return results
+
+def find_roots(options, config):
+    """Directories to search, per the --root globs and (with
+    --all-roots) the [roots] section of the config.  None if
+    neither option was given
+    """
+    patterns = list(getattr(options, OPT_ROOTS, None) or [])
+    all_roots = getattr(options, OPT_ALL_ROOTS, False)
+    if not (patterns or all_roots):
+        return None
+    if all_roots and config.has_section(CONF_SEC_ROOTS):
+        patterns.extend(
+            pattern
+            for _, pattern in config.items(CONF_SEC_ROOTS)
+            )
+    roots = []
+    for pattern in patterns:
+        for root in sorted(glob(os.path.expanduser(pattern))):
+            root = os.path.abspath(root)
+            if os.path.isdir(root) and root not in roots:
+                roots.append(root)
+    return roots
+
+def week_of(date_string):
+    "The ISO week (e.g. 2012-W07) of an RFC 2822 date, or None"
+    date = email.utils.parsedate_tz(date_string or "")
+    if not date:
+        return None
+    year, week, _ = datetime.date.fromtimestamp(
+        email.utils.mktime_tz(date)).isocalendar()
+    return "%04i-W%02i" % (year, week)
+
+def stats_keys(category, msg):
+    "The (dimension, value) counters that an item contributes to"
+    priority, _ = item_sort_key(msg)
+    name, address = email.utils.parseaddr(msg.get(HEAD_FROM, ""))
+    results = [
+        (STATS_CATEGORY, category),
+        (STATS_PRIORITY, PRIORITY_NUMBER_TO_NAME.get(priority, str(priority))),
+        (STATS_AUTHOR, address or name or "unknown"),
+        ]
+    for dimension, header in (
+            (STATS_WEEK, HEAD_DATE),
+            (STATS_CLOSED, HEAD_CLOSED),
+            ):
+        week = week_of(msg.get(header))
+        if week:
+            results.append((dimension, week))
+    return [
+        (dimension, re.sub(r"\s+", " ", value))
+        for dimension, value in results
+        ]
+
+def record_stats(todo_dir, removed=(), added=()):
+    """Journal the counter changes for items going away/appearing
+    'removed' and 'added' are sequences of (category, headers)
+    """
+    lines = []
+    for delta, items in ((-1, removed), (1, added)):
+        for category, msg in items:
+            lines.extend(
+                "%i\t%s\t%s\n" % (delta, dimension, value)
+                for dimension, value in stats_keys(category, msg)
+                )
+    if lines:
+        append_state(todo_dir, STATS_JOURNAL, lines)
+
+def apply_stats_journal(counters, fname, offset=0):
+    """Fold the complete lines of the journal in 'fname' after
+    'offset' into 'counters', returning the offset reached
+    """
+    f = file(fname, "rb")
+    try:
+        f.seek(offset)
+        data = f.read()
+    finally:
+        f.close()
+    end = data.rfind("\n") + 1
+    for line in data[:end].splitlines():
+        try:
+            delta, dimension, value = line.split("\t", 2)
+            delta = int(delta)
+        except ValueError:
+            # a torn write
+            continue
+        by_value = counters.setdefault(dimension, {})
+        by_value[value] = by_value.get(value, 0) + delta
+        if not by_value[value]:
+            del by_value[value]
+    return offset + end
+
+def valid_stats(state):
+    """Check the shape of the saved stats:
+    {"counters": {dimension: {value: count}},
+     "offsets": {generation: offset}, "next": generation}
+    """
+    counters = state["counters"]
+    return isinstance(counters, dict) and all(
+        isinstance(dimension, str)
+        and isinstance(by_value, dict)
+        and all(
+            isinstance(value, str) and isinstance(count, (int, long))
+            for value, count in by_value.iteritems()
+            )
+        for dimension, by_value in counters.iteritems()
+        ) and isinstance(state["next"], (int, long)) and all(
+            generation.isdigit() and isinstance(offset, (int, long))
+            for generation, offset in state["offsets"].iteritems()
+            )
+
+def journal_generations(todo_dir, name):
+    "The generation numbers of the folded journals 'name'.<n> on disk"
+    prefix = state_file(todo_dir, name) + "."
+    return sorted(
+        int(fname[len(prefix):])
+        for fname in glob(prefix + "*")
+        if fname[len(prefix):].isdigit()
+        )
+
+def peek_journals(todo_dir, name, state, apply_journal):
+    """Apply journal 'name' on top of 'state' without folding it,
+    for when somebody else holds the lock.  'state' carries the
+    "offsets" and "next" generation kept by fold_journals(), and
+    apply_journal(fname, offset) applies the complete lines
+    of 'fname' after 'offset', returning the offset reached
+    """
+    journal = state_file(todo_dir, name)
+    for generation in journal_generations(todo_dir, name):
+        offset = state["offsets"].get(str(generation), 0)
+        if generation < state["next"] and str(generation) not in (
+                state["offsets"]):
+            continue
+        try:
+            apply_journal("%s.%i" % (journal, generation), offset)
+        except IOError:
+            pass
+    if os.path.exists(journal):
+        apply_journal(journal, 0)
+
+def reset_journals(todo_dir, name, state):
+    """Throw away journal 'name' and its generations, as 'state'
+    has just been rebuilt from the items themselves
+    """
+    journal = state_file(todo_dir, name)
+    generations = journal_generations(todo_dir, name)
+    if os.path.exists(journal):
+        os.remove(journal)
+    for generation in generations:
+        os.remove("%s.%i" % (journal, generation))
+    state["offsets"] = {}
+    state["next"] = generations and generations[-1] + 1 or 0
+
+def fold_journals(todo_dir, name, state, apply_journal):
+    """Fold journal 'name' into 'state' (see peek_journals()),
+    with its lock held.  Folding is idempotent: the live journal
+    is renamed to a numbered generation and 'state' records how
+    far into each generation has been applied, so a crash before
+    the caller saves 'state' just means the same lines get
+    applied next time.  Once 'state' is saved, settle_journals()
+    cleans up
+    """
+    journal = state_file(todo_dir, name)
+    offsets = state["offsets"]
+    for generation in journal_generations(todo_dir, name):
+        if generation >= state["next"]:
+            # renamed, but the state wasn't saved
+            offsets[str(generation)] = 0
+            state["next"] = generation + 1
+    if os.path.exists(journal):
+        os.rename(journal, "%s.%i" % (journal, state["next"]))
+        offsets[str(state["next"])] = 0
+        state["next"] += 1
+    for generation, offset in sorted(offsets.items()):
+        fname = "%s.%s" % (journal, generation)
+        if not os.path.exists(fname):
+            del offsets[generation]
+            continue
+        offsets[generation] = apply_journal(fname, offset)
+
+def settle_journals(todo_dir, name, state):
+    """Remove the generations of journal 'name' which the saved
+    'state' has fully applied, once they have settled.  They
+    are kept until then to pick up late appends
+    """
+    journal = state_file(todo_dir, name)
+    for generation, offset in state["offsets"].items():
+        fname = "%s.%s" % (journal, generation)
+        st = os.stat(fname)
+        if (st.st_size == offset
+                and time.time() - st.st_mtime > JOURNAL_SETTLE_SECONDS):
+            # fully applied and nobody can still be writing to it;
+            # the next fold forgets about it
+            os.remove(fname)
+
+def reindex_stats(todo_dir):
+    "Recount everything from the items themselves"
+    counters = {}
+    for _, category, _, msg in scan_todo_dir(todo_dir):
+        for dimension, value in stats_keys(category, msg):
+            by_value = counters.setdefault(dimension, {})
+            by_value[value] = by_value.get(value, 0) + 1
+    return counters
+
+def read_stats(todo_dir, reindex=False):
+    """The current {dimension: {value: count}} counters
+    The journal is folded into the saved counters (see
+    fold_journals()).  If somebody else holds the lock, the
+    journals are just read on top of the saved counters
+    """
+    def apply_journal(fname, offset):
+        return apply_stats_journal(state["counters"], fname, offset)
+    if not try_lock(todo_dir, STATS_LOCK):
+        state = load_state(todo_dir, STATS_STATE, None, valid_stats)
+        if state is None:
+            return reindex_stats(todo_dir)
+        peek_journals(todo_dir, STATS_JOURNAL, state, apply_journal)
+        return state["counters"]
+    try:
+        state = load_state(todo_dir, STATS_STATE, None, valid_stats)
+        if reindex or state is None:
+            # changes made while recounting may be missed or
+            # counted twice; this is the repair tool after all
+            state = {}
+            reset_journals(todo_dir, STATS_JOURNAL, state)
+            state["counters"] = reindex_stats(todo_dir)
+        else:
+            fold_journals(todo_dir, STATS_JOURNAL, state, apply_journal)
+        save_state(todo_dir, STATS_STATE, state)
+        settle_journals(todo_dir, STATS_JOURNAL, state)
+    finally:
+        unlock(todo_dir, STATS_LOCK)
+    return state["counters"]
+
+def item_id(fname):
+    "The short ID of an item: the unique suffix of its filename"
+    stem = os.path.splitext(os.path.basename(fname))[0]
+    suffix = stem.rsplit("-", 1)[-1]
+    if re.match(r"^[0-9a-f]+$", suffix):
+        return suffix
+    return stem
+
+def completion_digest():
+    "Identifies the fixed part (commands etc.) of the completion cache"
+    return hashlib.sha1("\0".join(
+        [name for name, _ in CMDS] +
+        [name for name, _ in PRIORITIES] +
+        STATS_DIMENSIONS
+        )).hexdigest()[:12]
+
+def refresh_completions(todo_dir):
+    """Rebuild the shell-completion cache for 'todo_dir'
+    It is plain "kind<TAB>value" lines so that the completion
+    scripts can read it without starting Python.  The first
+    line records completion_digest() and the size of the rest,
+    for completions_stale()
+    """
+    lines = []
+    for name, _ in CMDS:
+        lines.append((COMPLETE_CMD, name))
+    for name, _ in PRIORITIES:
+        lines.append((COMPLETE_PRIORITY, name))
+    for dimension in STATS_DIMENSIONS:
+        lines.append((COMPLETE_DIMENSION, dimension))
+    for category in list_categories(todo_dir):
+        lines.append((COMPLETE_CATEGORY, category))
+        for fname in glob(os.path.join(todo_dir, category, "*mbox")):
+            lines.append((COMPLETE_ITEM, item_id(fname)))
+    body = ''.join("%s\t%s\n" % line for line in lines)
+    dest_dir = make_state_dir(todo_dir)
+    fd, tmp_name = tempfile.mkstemp(prefix=COMPLETE_CACHE, dir=dest_dir)
+    try:
+        f = os.fdopen(fd, "w")
+        try:
+            f.write("#\t%s\t%i\n" % (completion_digest(), len(body)))
+            f.write(body)
+        finally:
+            f.close()
+        os.chmod(tmp_name, 0644)
+        if IS_WINDOWS and os.path.exists(state_file(todo_dir, COMPLETE_CACHE)):
+            os.remove(state_file(todo_dir, COMPLETE_CACHE))
+        os.rename(tmp_name, state_file(todo_dir, COMPLETE_CACHE))
+    except:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def completions_stale(todo_dir):
+    """Whether the completion cache is missing, was built for
+    other commands, or has had so much appended to it (moves
+    re-add items, deleted items linger) that it needs rebuilding
+    """
+    fname = state_file(todo_dir, COMPLETE_CACHE)
+    try:
+        f = file(fname)
+        try:
+            header = f.readline()
+        finally:
+            f.close()
+        size = os.path.getsize(fname)
+    except (IOError, OSError):
+        return True
+    fields = header.rstrip("\n").split("\t")
+    if len(fields) != 3 or fields[0] != "#" or not fields[2].isdigit():
+        return True
+    if fields[1] != completion_digest():
+        return True
+    base = int(fields[2])
+    return size - len(header) - base > max(base, COMPLETE_SLACK)
+
+def note_completions(todo_dir, fnames):
+    """Add new items (and their categories) to an existing
+    completion cache.  Duplicates are weeded out when reading,
+    and the cache is rebuilt once it has grown too much
+    """
+    if not os.path.exists(state_file(todo_dir, COMPLETE_CACHE)):
+        return
+    lines = []
+    for fname in fnames:
+        lines.append("%s\t%s\n" % (
+            COMPLETE_CATEGORY,
+            os.path.basename(os.path.dirname(fname)),
+            ))
+        lines.append("%s\t%s\n" % (COMPLETE_ITEM, item_id(fname)))
+    append_state(todo_dir, COMPLETE_CACHE, lines)
+    if completions_stale(todo_dir):
+        refresh_completions(todo_dir)
+
+def completion_kinds(words):
+    """Which kinds of cached values can complete the last of 'words'
+    (the command line after the program name)
+    Mirrors the logic in COMPLETION_SCRIPT
+    """
+    prev = len(words) > 1 and words[-2] or ""
+    if prev in ("-p", "--priority"):
+        return [COMPLETE_PRIORITY]
+    cmd = None
+    for i, word in enumerate(words[:-1]):
+        if i and words[i-1] in ("-c", "--config", "-R", "--root"):
+            continue
+        if not word.startswith("-"):
+            cmd = word
+            break
+    if cmd is None or cmd == CMD_HELP:
+        return [COMPLETE_CMD]
+    if cmd == CMD_ADD:
+        return [COMPLETE_CATEGORY]
+    if cmd == CMD_STATS:
+        return [COMPLETE_DIMENSION]
+    return [COMPLETE_CATEGORY, COMPLETE_ITEM]
+
+def staging_mode(config):
+    mode = clean(config.get(CONF_SEC_CONFIG, CONF_STAGING))
+    if mode not in STAGING_MODES:
+        log.warning("Unknown staging mode %r, using %r", mode, DEF_STAGING)
+        mode = DEF_STAGING
+    return mode
+
+def stage_files(options, config, todo_dir, fnames, removed=(), vcs=None):
+    """Add 'fnames' (and the already-gone 'removed') to the VCS
+    In the journal/background staging modes they are just
+    appended to a journal for flush_staging() to add in one go
+    """
+    mode = staging_mode(config)
+    if mode == STAGING_IMMEDIATE:
+        if vcs is None:
+            try:
+                vcs = get_vcs(config)
+            except ValueError:
+                return
+        if removed:
+            vcs.remove_files(list(removed))
+        vcs.add_files(list(fnames))
+        return
+    append_state(todo_dir, STAGE_JOURNAL, [
+        os.path.abspath(fname) + "\n"
+        for fname in list(removed) + list(fnames)
+        ], sync=True)
+    if mode == STAGING_BACKGROUND:
+        spawn_flusher(options)
+
+def spawn_flusher(options):
+    "Start a detached \"pb sync\" to drain the staging journal"
+    args = [sys.executable, os.path.abspath(__file__)]
+    if getattr(options, OPT_CONFIG, None):
+        args.extend(["-c", getattr(options, OPT_CONFIG)])
+    args.append(CMD_SYNC)
+    if IS_WINDOWS:
+        DETACHED_PROCESS = 0x00000008
+        kwargs = dict(creationflags=DETACHED_PROCESS)
+    else:
+        kwargs = dict(close_fds=True, preexec_fn=os.setsid)
+    devnull = open(os.devnull, "r+")
+    try:
+        subprocess.Popen(args,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            **kwargs
+            )
+    finally:
+        devnull.close()
+
+def read_stage_journal(fname, offset):
+    """The distinct paths in the complete lines of the journal
+    'fname' after 'offset', and the offset reached
+    """
+    f = file(fname, "rb")
+    try:
+        f.seek(offset)
+        data = f.read()
+    finally:
+        f.close()
+    end = data.rfind("\n") + 1
+    fnames = []
+    seen = set()
+    for fname in data[:end].splitlines():
+        if fname and fname not in seen:
+            seen.add(fname)
+            fnames.append(fname)
+    return fnames, offset + end
+
+def valid_stage_offset(saved):
+    "Check the shape of the saved offset: [inode, offset]"
+    return len(saved) == 2 and all(is_number(value) for value in saved)
+
+def flush_staging(config, todo_dir, wait=False):
+    """Hand every journaled path to the VCS in one batch
+    Returns the number of paths staged.  If somebody else is
+    already flushing, give up (or with 'wait', wait for them
+    and then flush whatever they left).  If the VCS fails,
+    the paths stay queued for next time.  A writer may still
+    append to the journal just after it is renamed, so it's
+    only removed once it has settled (without 'wait', it is
+    left for next time, with how far it has been staged)
+    """
+    journal = state_file(todo_dir, STAGE_JOURNAL)
+    draining = journal + ".draining"
+    if not (os.path.exists(journal) or os.path.exists(draining)):
+        return 0
+    while not try_lock(todo_dir, STAGE_LOCK):
+        if not wait:
+            return 0
+        time.sleep(0.05)
+    staged = 0
+    try:
+        try:
+            vcs = get_vcs(config)
+        except ValueError:
+            vcs = None
+        # a previous attempt's paths go first
+        while True:
+            if not os.path.exists(draining):
+                if not os.path.exists(journal):
+                    break
+                os.rename(journal, draining)
+            inode = os.stat(draining).st_ino
+            saved = load_state(todo_dir, STAGE_OFFSET, None,
+                valid_stage_offset)
+            offset = 0
+            if saved is not None and saved[0] == inode:
+                offset = saved[1]
+            fnames, new_offset = read_stage_journal(draining, offset)
+            if fnames:
+                if vcs is None:
+                    log.info("No VCS to stage %i file(s) with", len(fnames))
+                else:
+                    existing = [f for f in fnames if os.path.exists(f)]
+                    missing = [f for f in fnames if not os.path.exists(f)]
+                    if not ((not missing or vcs.remove_files(missing))
+                            and (not existing or vcs.add_files(existing))):
+                        log.warning(
+                            "Staging failed, leaving %i file(s) queued",
+                            len(fnames))
+                        break
+                save_state(todo_dir, STAGE_OFFSET, [inode, new_offset])
+                staged += len(fnames)
+            st = os.stat(draining)
+            if st.st_size > new_offset and new_offset > offset:
+                # appended to while we were staging
+                continue
+            age = time.time() - st.st_mtime
+            if age <= STAGE_SETTLE_SECONDS:
+                if not wait:
+                    break
+                time.sleep(STAGE_SETTLE_SECONDS - age + 0.1)
+                continue
+            # settled: anything left after new_offset is a torn write
+            for fname in (state_file(todo_dir, STAGE_OFFSET), draining):
+                try:
+                    os.remove(fname)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+    finally:
+        unlock(todo_dir, STAGE_LOCK)
+    return staged
+
+def record_queue(config, todo_dir, removed=(), added=()):
+    """Journal the queue changes for items going away/appearing
+    'removed' are relative names, 'added' (relative name, headers)
+    """
+    done_category = config.get(CONF_SEC_CONFIG, CONF_DONE_CATEGORY)
+    lines = ["-\t%s\n" % relname for relname in removed]
+    for relname, msg in added:
+        if os.path.dirname(relname) != done_category:
+            priority, when = item_sort_key(msg)
+            lines.append("+\t%i\t%i\t%s\n" % (priority, when, relname))
+    if lines:
+        append_state(todo_dir, QUEUE_JOURNAL, lines)
+
+def apply_queue_journal(queue, fname, offset=0):
+    """Apply the complete lines of the journal in 'fname' after
+    'offset' to 'queue', returning the offset reached
+    """
+    f = file(fname, "rb")
+    try:
+        f.seek(offset)
+        data = f.read()
+    finally:
+        f.close()
+    end = data.rfind("\n") + 1
+    for line in data[:end].splitlines():
+        fields = line.split("\t")
+        try:
+            if fields[0] == "-" and len(fields) == 2:
+                queue["current"].pop(fields[1], None)
+            elif fields[0] == "+" and len(fields) == 4:
+                key = [int(fields[1]), int(fields[2])]
+                queue["current"][fields[3]] = key
+                heapq.heappush(queue["heap"], key + [fields[3]])
+        except ValueError:
+            # a torn write
+            continue
+    return offset + end
+
+def valid_queue(queue):
+    """Check the shape of the saved queue:
+    {"heap": [[priority, date, relname]],
+     "current": {relname: [priority, date]},
+     "offsets": {generation: offset}, "next": generation}
+    """
+    return all(
+        len(entry) == 3
+        and is_number(entry[0])
+        and is_number(entry[1])
+        and isinstance(entry[2], str)
+        for entry in queue["heap"]
+        ) and all(
+        isinstance(relname, str)
+        and len(key) == 2
+        and is_number(key[0])
+        and is_number(key[1])
+        for relname, key in queue["current"].iteritems()
+        ) and isinstance(queue["next"], (int, long)) and all(
+            generation.isdigit() and isinstance(offset, (int, long))
+            for generation, offset in queue["offsets"].iteritems()
+            )
+
+def reindex_queue(config, todo_dir):
+    "Rebuild the heap of open items from the items themselves"
+    done_category = config.get(CONF_SEC_CONFIG, CONF_DONE_CATEGORY)
+    current = dict(
+        (os.path.join(category, os.path.basename(fname)), list(key))
+        for key, category, fname, _ in scan_todo_dir(todo_dir)
+        if category != done_category
+        )
+    # a sorted list is already a heap
+    heap = sorted(key + [relname] for relname, key in current.iteritems())
+    return {"heap": heap, "current": current}
+
+def iter_queue(queue):
+    """Pop (sort key, relative name) off the heap of 'queue' as
+    far as the caller reads, skipping entries that an edit or
+    close has since superseded
+    """
+    heap = queue["heap"]
+    current = queue["current"]
+    while heap:
+        priority, when, relname = heapq.heappop(heap)
+        if current.get(relname) == [priority, when]:
+            # so a duplicate entry isn't yielded again
+            del current[relname]
+            yield (priority, when), relname
+
+def load_queue(config, todo_dir, reindex=False):
+    """Yield (sort key, relative name) for the open items,
+    most-important-first.  They are kept as a heap in the state
+    directory, which add/edit/close update through a journal
+    (see record_queue()) folded in like the stats journal, so
+    no item has to be looked at.  Items edited by hand need a
+    'reindex' to be noticed
+    """
+    def apply_journal(fname, offset):
+        return apply_queue_journal(queue, fname, offset)
+    if not try_lock(todo_dir, QUEUE_LOCK):
+        queue = load_state(todo_dir, QUEUE_STATE, None, valid_queue)
+        if queue is None:
+            return iter_queue(reindex_queue(config, todo_dir))
+        peek_journals(todo_dir, QUEUE_JOURNAL, queue, apply_journal)
+        return iter_queue(queue)
+    try:
+        queue = load_state(todo_dir, QUEUE_STATE, None, valid_queue)
+        if reindex or queue is None:
+            queue = {}
+            reset_journals(todo_dir, QUEUE_JOURNAL, queue)
+            queue.update(reindex_queue(config, todo_dir))
+        else:
+            fold_journals(todo_dir, QUEUE_JOURNAL, queue, apply_journal)
+            if len(queue["heap"]) > len(queue["current"]) + QUEUE_SLACK:
+                queue["heap"] = sorted(
+                    key + [relname]
+                    for relname, key in queue["current"].iteritems()
+                    )
+        save_state(todo_dir, QUEUE_STATE, queue)
+        settle_journals(todo_dir, QUEUE_JOURNAL, queue)
+    finally:
+        unlock(todo_dir, QUEUE_LOCK)
+    return iter_queue(queue)
+
+def claim_file(todo_dir, ident):
+    claims_dir = os.path.join(make_state_dir(todo_dir), CLAIMS_DIRNAME)
+    if not os.path.isdir(claims_dir):
+        try:
+            os.mkdir(claims_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    return os.path.join(claims_dir, ident)
+
+def claim_expired(fname):
+    """Whether the claim in 'fname' has run out
+    Claims are never seen partly written (see claim_item()),
+    so one that can't be read is garbage and runs out like a
+    stale lock, LOCK_STALE_SECONDS after it was made
+    """
+    try:
+        f = file(fname)
+        try:
+            expires = f.readline().split("\t", 1)[0]
+        finally:
+            f.close()
+        made = os.stat(fname).st_mtime
+    except (IOError, OSError), e:
+        if e.errno != errno.ENOENT:
+            raise
+        return True
+    try:
+        return float(expires) < time.time()
+    except ValueError:
+        return time.time() - made > LOCK_STALE_SECONDS
+
+def claim_item(todo_dir, ident, worker, lease):
+    """Atomically claim item 'ident' for 'lease' seconds
+    Returns False if somebody else holds a current claim.
+    An expired claim is only broken while holding a per-item
+    lock, so two workers can't both take it over
+    """
+    fname = claim_file(todo_dir, ident)
+    for attempt in range(2):
+        if not create_exclusive(fname,
+                "%f\t%s\n" % (time.time() + lease, worker)):
+            if attempt or not claim_expired(fname):
+                return False
+            lock_name = os.path.join(CLAIMS_DIRNAME, ident + ".lock")
+            if not try_lock(todo_dir, lock_name):
+                return False
+            try:
+                if claim_expired(fname):
+                    log.info("Claim on %s has expired", ident)
+                    release_item(todo_dir, ident)
+            finally:
+                unlock(todo_dir, lock_name)
+            continue
+        return True
+    return False
+
+def release_item(todo_dir, ident):
+    "Drop any claim on item 'ident'"
+    try:
+        os.remove(claim_file(todo_dir, ident))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def move_item(vcs, fname, dest_dir):
+    """Move 'fname' into 'dest_dir', via the VCS if possible
+    Returns the new location
+    """
+    dest = os.path.join(dest_dir, os.path.basename(fname))
+    if vcs is not None:
+        vcs.move_file(fname, dest)
+    if os.path.exists(fname):
+        # not under version control (or no VCS at all)
+        os.rename(fname, dest)
+    return dest
+
 ##################################################
 # helper class for VCS integration
 ##################################################
@@ -378,38 +1845,218 @@ class VCS(object):
             fname,
             self.__class__.__name__,
             )
+    def add_files(self, fnames):
+        "Returns whether it worked"
+        log.info("Adding %i file(s) to %s control",
+            len(fnames),
+            self.__class__.__name__,
+            )
+        return True
+    def remove_files(self, fnames):
+        """Record that 'fnames' have already been removed
+        Returns whether it worked
+        """
+        log.info("Removing %i file(s) from %s control",
+            len(fnames),
+            self.__class__.__name__,
+            )
+        return True
     def move_file(self, existing_file, dest):
         pass
-    def _output_of(self, *cmd):
+    def list_files_at(self, rev, dirname):
+        "Full names of the files under 'dirname' as of 'rev'"
+        raise NotImplementedError(
+            "%s can't read old revisions" % self.__class__.__name__)
+    def cat_file_at(self, rev, fname):
+        "The content of 'fname' as of 'rev'"
+        raise NotImplementedError(
+            "%s can't read old revisions" % self.__class__.__name__)
+    def iter_headers_at(self, rev, fnames):
+        "Yield (fname, headers) for each of 'fnames' as of 'rev'"
+        for fname in fnames:
+            yield fname, headers_from_lines(
+                StringIO(self.cat_file_at(rev, fname)))
+    def iter_contents_at(self, rev, fnames):
+        "Yield (fname, content) for each of 'fnames' as of 'rev'"
+        for fname in fnames:
+            yield fname, self.cat_file_at(rev, fname)
+    def _iter_exported(self, exported, method):
+        """Yield (fname, headers or content) for each pair of
+        (fname, exported copy) in 'exported' which got written
+        """
+        for fname, copy in exported:
+            try:
+                f = file(copy, "rb")
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                if method == "headers":
+                    yield fname, headers_from_lines(f)
+                else:
+                    yield fname, f.read()
+            finally:
+                f.close()
+    def _succeeds(self, *cmd, **kwargs):
+        "a helper function to run a command, reporting whether it worked"
+        import subprocess as sub
+        proc = sub.Popen(cmd,
+            stderr=sub.PIPE,
+            stdout=sub.PIPE,
+            cwd=kwargs.get("cwd"),
+            )
+        output, errors = proc.communicate()
+        if proc.returncode:
+            log.warning("%s failed (%i): %s",
+                cmd[0], proc.returncode, errors.strip())
+        return proc.returncode == 0
+    def _output_of(self, *cmd, **kwargs):
         "a helper function to fetch the output of a given command"
         import subprocess as sub
-        proc = sub.Popen(cmd, stderr=sub.PIPE, stdout=sub.PIPE)
+        proc = sub.Popen(cmd,
+            stderr=sub.PIPE,
+            stdout=sub.PIPE,
+            cwd=kwargs.get("cwd"),
+            )
         output, errors = proc.communicate()
         return output
 
+class GitCatFile(object):
+    """A long-lived "git cat-file --batch" coprocess, so reading
+    many blobs doesn't cost a subprocess apiece
+    """
+    def __init__(self, cwd):
+        self.proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=cwd,
+            )
+        self.remaining = 0
+    def _request(self, spec):
+        "Ask for 'spec', returning its size or None if it's missing"
+        self.proc.stdin.write(spec + "\n")
+        self.proc.stdin.flush()
+        info = self.proc.stdout.readline().split()
+        if len(info) != 3:
+            log.debug("No blob %r: %r", spec, info)
+            return None
+        self.remaining = int(info[2])
+        return self.remaining
+    def _lines(self):
+        "Iterate over the lines of the current blob"
+        while self.remaining:
+            line = self.proc.stdout.readline(self.remaining)
+            if not line:
+                raise IOError("git cat-file ended unexpectedly")
+            self.remaining -= len(line)
+            yield line
+    def _finish(self):
+        "Skip whatever is left of the current blob"
+        while self.remaining:
+            chunk = self.proc.stdout.read(min(self.remaining, 64 * 1024))
+            if not chunk:
+                raise IOError("git cat-file ended unexpectedly")
+            self.remaining -= len(chunk)
+        self.proc.stdout.read(1) # the LF after each blob
+    def headers(self, spec):
+        "The header block of blob 'spec', skipping the rest unread"
+        if self._request(spec) is None:
+            return None
+        try:
+            return headers_from_lines(self._lines())
+        finally:
+            self._finish()
+    def read(self, spec):
+        "The full content of blob 'spec'"
+        size = self._request(spec)
+        if size is None:
+            return None
+        content = self.proc.stdout.read(size)
+        self.remaining -= len(content)
+        self._finish()
+        return content
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
 class Git(VCS):
     NAMES = ["git"]
     @classmethod
     def is_here(self, dir):
-        return bool(find_dir('.git'))
+        return bool(find_dir('.git', start=dir))
     def get_name(self):
-        return self._output_of("git config --get user.name") or self.default_user
+        return (self._output_of("git", "config", "--get", "user.name",
+            cwd=self.dir).strip() or self.default_user)
     def get_email(self):
-        return self._output_of("git config --get user.email") or self.default_email
+        return (self._output_of("git", "config", "--get", "user.email",
+            cwd=self.dir).strip() or self.default_email)
     def get_rev(self):
-        return self._output_of("git rev-parse HEAD")
+        return self._output_of("git", "rev-parse", "HEAD",
+            cwd=self.dir).strip()
     def add_file(self, fname):
         super(Git, self).add_file(fname)
         return self._output_of("git", "add", fname)
+    def add_files(self, fnames):
+        super(Git, self).add_files(fnames)
+        if fnames:
+            return self._succeeds("git", "add", *fnames)
+        return True
+    def remove_files(self, fnames):
+        super(Git, self).remove_files(fnames)
+        if fnames:
+            return self._succeeds("git", "rm",
+                "--cached", "--quiet", "--ignore-unmatch", "--", *fnames)
+        return True
     def move_file(self, existing_file, dest):
         super(Git, self).move_file(existing_file, dest)
         return self._output_of("git", "mv", existing_file, dest)
+    def _top(self, dirname):
+        return os.path.realpath(self._output_of(
+            "git", "rev-parse", "--show-toplevel", cwd=dirname).strip())
+    def list_files_at(self, rev, dirname):
+        top = self._top(dirname)
+        if not self._output_of("git", "rev-parse", "--verify", "--quiet",
+                rev + "^{tree}", cwd=top).strip():
+            raise ValueError("Unknown revision %r" % rev)
+        output = self._output_of(
+            "git", "ls-tree", "-r", "-z", "--name-only", "--full-tree",
+            rev, "--", os.path.relpath(os.path.realpath(dirname), top),
+            cwd=top)
+        return [
+            os.path.join(top, name)
+            for name in output.split("\0")
+            if name
+            ]
+    def _iter_at(self, rev, fnames, method):
+        fnames = list(fnames)
+        if not fnames:
+            return
+        top = self._top(existing_dir(fnames[0]))
+        cat_file = GitCatFile(top)
+        try:
+            for fname in fnames:
+                spec = "%s:%s" % (rev, os.path.relpath(
+                    os.path.realpath(fname), top).replace(os.sep, "/"))
+                result = getattr(cat_file, method)(spec)
+                if result is not None:
+                    yield fname, result
+        finally:
+            cat_file.close()
+    def cat_file_at(self, rev, fname):
+        for _, content in self._iter_at(rev, [fname], "read"):
+            return content
+    def iter_headers_at(self, rev, fnames):
+        return self._iter_at(rev, fnames, "headers")
+    def iter_contents_at(self, rev, fnames):
+        return self._iter_at(rev, fnames, "read")
 
 class CombinedUserEmailVCS(VCS):
     def __init__(self, dir, config):
         VCS.__init__(self, dir, config)
         info = self.get_useremail()
-        user_email_re = re.compile('(.*?) +<(.*)$')
+        user_email_re = re.compile('(.*?) +<(.*)>$')
         m = user_email_re.match(info)
         if m:
             self.name, self.email = [s.strip() for s in m.groups()]
@@ -426,48 +2073,178 @@ class Bazaar(CombinedUserEmailVCS):
     NAMES = ["bzr", "Bazaar"]
     @classmethod
     def is_here(self, dir):
-        return bool(find_dir('.bzr'))
+        return bool(find_dir('.bzr', start=dir))
     def get_useremail(self):
-        info = self._output_of("bzr whoami")
+        return self._output_of("bzr", "whoami", cwd=self.dir).strip()
     def get_rev(self):
-        return self._output_of("bzr version-info --template='{revision_id}' --custom")
+        return self._output_of("bzr", "version-info", "--custom",
+            "--template={revision_id}", cwd=self.dir).strip()
     def add_file(self, fname):
         super(Bazaar, self).add_file(fname)
         return self._output_of("bzr", "add", fname)
+    def add_files(self, fnames):
+        super(Bazaar, self).add_files(fnames)
+        if fnames:
+            return self._succeeds("bzr", "add", *fnames)
+        return True
+    def remove_files(self, fnames):
+        super(Bazaar, self).remove_files(fnames)
+        if fnames:
+            return self._succeeds("bzr", "remove", "--keep", *fnames)
+        return True
     def move_file(self, existing_file, dest):
         super(Bazaar, self).move_file(existing_file, dest)
         return self._output_of("bzr", "mv", existing_file, dest)
+    def list_files_at(self, rev, dirname):
+        top = os.path.realpath(
+            self._output_of("bzr", "root", dirname).strip())
+        prefix = os.path.relpath(os.path.realpath(dirname), top) + "/"
+        output = self._output_of(
+            "bzr", "ls", "-R", "--kind=file", "--from-root", "-r", rev,
+            cwd=top)
+        return [
+            os.path.join(top, name)
+            for name in output.splitlines()
+            if name.startswith(prefix)
+            ]
+    def cat_file_at(self, rev, fname):
+        return self._output_of("bzr", "cat", "-r", rev, fname)
 
 class Mercurial(CombinedUserEmailVCS):
     NAMES = ["hg", "Mercurial"]
     @classmethod
     def is_here(self, dir):
-        return bool(find_dir('.hg'))
+        return bool(find_dir('.hg', start=dir))
     def get_useremail(self):
-        info = self._output_of("hg showconfig ui.username")
+        return self._output_of("hg", "showconfig", "ui.username",
+            cwd=self.dir).strip()
     def get_rev(self):
-        return self._output_of("hg parents --template '{node}'")
+        return self._output_of("hg", "parents", "--template", "{node}",
+            cwd=self.dir).strip()
     def add_file(self, fname):
         super(Mercurial, self).add_file(fname)
         return self._output_of("hg", "add", fname)
+    def add_files(self, fnames):
+        super(Mercurial, self).add_files(fnames)
+        if fnames:
+            return self._succeeds("hg", "add", *fnames)
+        return True
+    def remove_files(self, fnames):
+        super(Mercurial, self).remove_files(fnames)
+        if fnames:
+            return self._succeeds("hg", "remove", "--after", *fnames)
+        return True
     def move_file(self, existing_file, dest):
         super(Mercurial, self).move_file(existing_file, dest)
         return self._output_of("hg", "mv", existing_file, dest)
+    def list_files_at(self, rev, dirname):
+        top = os.path.realpath(
+            self._output_of("hg", "root", cwd=dirname).strip())
+        prefix = os.path.relpath(os.path.realpath(dirname), top) + "/"
+        output = self._output_of("hg", "manifest", "-r", rev, cwd=top)
+        return [
+            os.path.join(top, name)
+            for name in output.splitlines()
+            if name.startswith(prefix)
+            ]
+    def cat_file_at(self, rev, fname):
+        return self._output_of("hg", "cat", "-r", rev, fname)
+    def _iter_at(self, rev, fnames, method):
+        "Write all of 'fnames' out with a single \"hg cat\""
+        fnames = list(fnames)
+        if not fnames:
+            return
+        top = os.path.realpath(self._output_of(
+            "hg", "root", cwd=existing_dir(fnames[0])).strip())
+        names = [
+            os.path.relpath(os.path.realpath(fname), top)
+            for fname in fnames
+            ]
+        tmp_dir = tempfile.mkdtemp(prefix=".%s-" % APP_NAME)
+        try:
+            if not self._succeeds("hg", "cat", "-r", rev,
+                    "-o", os.path.join(tmp_dir, "%p"), *names, cwd=top):
+                raise ValueError("Can't read revision %r" % rev)
+            for result in self._iter_exported(
+                    [
+                        (fname, os.path.join(tmp_dir, name))
+                        for fname, name in zip(fnames, names)
+                        ],
+                    method):
+                yield result
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    def iter_headers_at(self, rev, fnames):
+        return self._iter_at(rev, fnames, "headers")
+    def iter_contents_at(self, rev, fnames):
+        return self._iter_at(rev, fnames, "read")
 
 class Subversion(VCS):
     NAMES = ["svn", "Subversion"]
     @classmethod
     def is_here(self, dir):
         # Subversion only checks the current directory
-        return os.path.isdir('.svn')
+        return os.path.isdir(os.path.join(dir, '.svn'))
     def get_rev(self):
         return self._output_of("svnversion")
     def add_file(self, fname):
         super(Subversion, self).add_file(fname)
         return self._output_of("svn", "add", fname)
+    def add_files(self, fnames):
+        super(Subversion, self).add_files(fnames)
+        if fnames:
+            return self._succeeds("svn", "add", *fnames)
+        return True
+    def remove_files(self, fnames):
+        super(Subversion, self).remove_files(fnames)
+        if fnames:
+            return self._succeeds("svn", "rm", "--keep-local", *fnames)
+        return True
     def move_file(self, existing_file, dest):
         super(Subversion, self).move_file(existing_file, dest)
         return self._output_of("svn", "mv", existing_file, dest)
+    def list_files_at(self, rev, dirname):
+        output = self._output_of("svn", "ls", "-R", "-r", rev, dirname)
+        return [
+            os.path.join(dirname, name)
+            for name in output.splitlines()
+            if name and not name.endswith("/")
+            ]
+    def cat_file_at(self, rev, fname):
+        return self._output_of("svn", "cat", "-r", rev, fname)
+    def _iter_at(self, rev, fnames, method):
+        """Export the directory holding all of 'fnames' with a
+        single "svn export" (several targets given to "svn cat"
+        come back run together, with no way to split them)
+        """
+        fnames = list(fnames)
+        if not fnames:
+            return
+        prefix = os.path.commonprefix([
+            os.path.dirname(fname) + os.sep
+            for fname in fnames
+            ])
+        top = prefix[:prefix.rindex(os.sep)]
+        tmp_dir = tempfile.mkdtemp(prefix=".%s-" % APP_NAME)
+        try:
+            copy_dir = os.path.join(tmp_dir, "export")
+            if not self._succeeds("svn", "export", "--quiet", "-r", rev,
+                    top, copy_dir):
+                raise ValueError("Can't read revision %r" % rev)
+            for result in self._iter_exported(
+                    [
+                        (fname, os.path.join(
+                            copy_dir, os.path.relpath(fname, top)))
+                        for fname in fnames
+                        ],
+                    method):
+                yield result
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    def iter_headers_at(self, rev, fnames):
+        return self._iter_at(rev, fnames, "headers")
+    def iter_contents_at(self, rev, fnames):
+        return self._iter_at(rev, fnames, "read")
 
 VCS_HELPERS = [
     Git,
@@ -554,61 +2331,248 @@ def do_add(options, config, args):
         category = choose("Category", sorted(categories))
     log.info("Category %r", category)
 
-    subject = ''
-    while not subject:
-        if add_args:
-            subject = ' '.join(arg.strip() for arg in add_args)
-        else:
-            subject = get_input("Summary").strip()
-    log.info("Subject %r", subject)
-
-    if getattr(add_options, OPT_GATHER_MESSAGE):
-        orig_content = make_message(comments=subject.encode("string_escape"))
-        content = edit(getattr(add_options, CONF_EDITOR), orig_content)
-        content = clean_message(content)
+    if getattr(add_options, OPT_BATCH):
+        # one summary per line, no editor
+        subjects = [line.strip() for line in sys.stdin if line.strip()]
+        contents = [subject + '\n' for subject in subjects]
     else:
-        content = subject + '\n'
+        subject = ''
+        while not subject:
+            if add_args:
+                subject = ' '.join(arg.strip() for arg in add_args)
+            else:
+                subject = get_input("Summary").strip()
+        log.info("Subject %r", subject)
+
+        if getattr(add_options, OPT_GATHER_MESSAGE):
+            orig_content = make_message(
+                comments=subject.encode("string_escape"))
+            content = edit(getattr(add_options, CONF_EDITOR), orig_content)
+            content = clean_message(content)
+        else:
+            content = subject + '\n'
+        subjects = [subject]
+        contents = [content]
 
     todo_dir = find_dir_based_on_config(config)
     dest_dir = find_or_create_category_dir(todo_dir, category)
-    fname = transform_subject_to_filename(subject) + ".mbox"
-    item = build_item(
-        getattr(add_options, OPT_USERNAME),
-        getattr(add_options, OPT_EMAIL),
-        subject,
-        category,
-        clean(getattr(add_options, OPT_PRIORITY)),
-        getattr(add_options, OPT_REVISION),
-        content,
-        getattr(add_options, OPT_ATTACHMENTS),
-        )
-    full_fname = os.path.join(dest_dir, fname)
-    log.debug("Location %r", full_fname)
-    mbox = mailbox.mbox(full_fname)
-    results.append("Added " + os.path.relpath(full_fname))
-    mbox.lock()
+    staged = []
     try:
-        mbox.add(item)
+        for subject, content in zip(subjects, contents):
+            item = build_item(
+                getattr(add_options, OPT_USERNAME),
+                getattr(add_options, OPT_EMAIL),
+                subject,
+                category,
+                clean(getattr(add_options, OPT_PRIORITY)),
+                getattr(add_options, OPT_REVISION),
+                content,
+                getattr(add_options, OPT_ATTACHMENTS),
+                )
+            staged.append((subject, stage_item(dest_dir, item)))
+        # group-commit: sync every staged item before publishing any
+        fsync_paths(tmp_name for _, tmp_name in staged)
+        added = []
+        while staged:
+            subject, tmp_name = staged[0]
+            full_fname = publish_item(tmp_name, dest_dir, subject)
+            # only now is the temp file gone
+            del staged[0]
+            log.debug("Location %r", full_fname)
+            results.append("Added " + os.path.relpath(full_fname))
+            added.append(full_fname)
     finally:
-        mbox.unlock()
-    try:
-        vcs = get_vcs(config)
-    except ValueError:
-        pass
-    else:
-        vcs.add_file(full_fname)
+        for _, tmp_name in staged:
+            os.remove(tmp_name)
+    fsync_paths([dest_dir])
+    category = os.path.basename(dest_dir)
+    headers = [(fname, read_headers(fname)) for fname in added]
+    record_stats(todo_dir, added=[
+        (category, msg)
+        for fname, msg in headers
+        ])
+    record_queue(config, todo_dir, added=[
+        (os.path.join(category, os.path.basename(fname)), msg)
+        for fname, msg in headers
+        ])
+    note_completions(todo_dir, added)
+    stage_files(options, config, todo_dir, added)
     return results
 
 def do_close(options, config, args):
-    """List completion options
+    """Close matching items
+    Usage: close QUERY...
+    Moves the items into the done category, noting
+    when they were closed in their headers.
     """
     results = []
+    if not args:
+        results.append("Specify a query to select the items to close")
+        return results
+    todo_dir = find_dir_based_on_config(config)
+    query = parse_query(args, list_categories(todo_dir))
+    matches = [
+        fname
+        for fname in iter_todos(config, include_done=False, todo_dir=todo_dir)
+        if item_matches(fname, query)
+        ]
+    if not matches:
+        results.append("No matching items")
+        return results
+    done_category = config.get(CONF_SEC_CONFIG, CONF_DONE_CATEGORY)
+    for fname in change_items(
+            options,
+            config,
+            todo_dir,
+            matches,
+            [],
+            new_category=done_category,
+            ):
+        results.append("Closed " + os.path.relpath(fname))
     return results
 
 def do_edit(options, config, args):
-    """Edit an existing item
+    """Edit the headers of all items matching a query
+    Usage: edit [options] QUERY...
+    QUERY terms may be a category name, "Header:value"
+    to match a header, or text found in the subject.
+    Only the header block of each item is rewritten.
+    """
+    results = []
+    parser = edit_options(config)
+    edit_options_, edit_args = parser.parse_args(args)
+    if not edit_args:
+        results.append("Specify a query to select the items to edit")
+        return results
+
+    changes = []
+    priority = getattr(edit_options_, OPT_PRIORITY)
+    if priority is not None:
+        changes.append((HEAD_PRIORITY, make_priority_string(priority)))
+    revision = getattr(edit_options_, OPT_REVISION)
+    if revision is not None:
+        changes.append((HEAD_REVISION, revision or None))
+    for header in getattr(edit_options_, OPT_HEADERS):
+        if ':' not in header:
+            results.append("Headers must be given as \"Name: value\"")
+            return results
+        name, value = header.split(':', 1)
+        name = name.strip()
+        if not re.match(r"^%s$" % HEADER_NAME_RE, name):
+            results.append("Invalid header name %r" % name)
+            return results
+        changes.append((name, value.strip() or None))
+    username = getattr(edit_options_, OPT_USERNAME)
+    email_address = getattr(edit_options_, OPT_EMAIL)
+    for value in [value for _, value in changes] + [username, email_address]:
+        if value and ("\r" in value or "\n" in value):
+            results.append("Header values can't span lines: %r" % value)
+            return results
+    new_category = getattr(edit_options_, OPT_CATEGORY)
+    if not (changes or username or email_address or new_category):
+        results.append("Nothing to change")
+        return results
+
+    todo_dir = find_dir_based_on_config(config)
+    query = parse_query(edit_args, list_categories(todo_dir))
+    matches = [
+        fname
+        for fname in iter_todos(config, todo_dir=todo_dir)
+        if item_matches(fname, query)
+        ]
+    if not matches:
+        results.append("No matching items")
+        return results
+    for fname in change_items(
+            options,
+            config,
+            todo_dir,
+            matches,
+            changes,
+            username,
+            email_address,
+            new_category,
+            ):
+        results.append("Edited " + os.path.relpath(fname))
+    return results
+
+def change_items(
+        options,
+        config,
+        todo_dir,
+        fnames,
+        changes,
+        username=None,
+        email_address=None,
+        new_category=None,
+        ):
+    """Apply header 'changes' to each of 'fnames', optionally
+    moving them to 'new_category' (closing/reopening them as
+    needed), then stage them all with one VCS command.
+    Returns the new locations
     """
+    vcs = None
+    if staging_mode(config) == STAGING_IMMEDIATE:
+        try:
+            vcs = get_vcs(config)
+        except ValueError:
+            pass
+    done_category = clean(config.get(CONF_SEC_CONFIG, CONF_DONE_CATEGORY))
+    if new_category:
+        dest_dir = find_or_create_category_dir(todo_dir, new_category)
+        closing = clean(os.path.basename(dest_dir)) == done_category
     results = []
+    moved_from = []
+    removed = []
+    added = []
+    queue_removed = []
+    queue_added = []
+    for fname in fnames:
+        old_msg = read_headers(fname)
+        old_category = os.path.basename(os.path.dirname(fname))
+        queue_removed.append(
+            os.path.join(old_category, os.path.basename(fname)))
+        item_changes = list(changes)
+        if username or email_address:
+            old_user, old_email = email.utils.parseaddr(
+                old_msg.get(HEAD_FROM, ""))
+            item_changes.append((HEAD_FROM, email.utils.formataddr((
+                username or old_user,
+                email_address or old_email,
+                ))))
+        moving = new_category and os.path.dirname(fname) != dest_dir
+        if moving:
+            if not closing:
+                item_changes.append((HEAD_CLOSED, None))
+            elif HEAD_CLOSED not in old_msg:
+                item_changes.append((HEAD_CLOSED, email.utils.formatdate()))
+        if item_changes:
+            log.debug("Rewriting %r with %r", fname, item_changes)
+            rewrite_headers(fname, item_changes)
+        if moving and closing:
+            release_item(todo_dir, item_id(fname))
+        if moving:
+            # without a VCS here (deferred staging), this is a plain
+            # rename which flush_staging() tells the VCS about later
+            moved_from.append(fname)
+            fname = move_item(vcs, fname, dest_dir)
+        item_category = os.path.basename(os.path.dirname(fname))
+        new_msg = read_headers(fname)
+        removed.append((old_category, old_msg))
+        added.append((item_category, new_msg))
+        queue_added.append((
+            os.path.join(item_category, os.path.basename(fname)),
+            new_msg,
+            ))
+        results.append(fname)
+    record_stats(todo_dir, removed, added)
+    record_queue(config, todo_dir, queue_removed, queue_added)
+    if new_category:
+        note_completions(todo_dir, results)
+    if vcs is not None:
+        vcs.add_files(results)
+    elif staging_mode(config) != STAGING_IMMEDIATE:
+        stage_files(options, config, todo_dir, results, moved_from)
     return results
 
 def do_comment(options, config, args):
@@ -619,29 +2583,672 @@ def do_comment(options, config, args):
 
 def do_show(options, config, args):
     """Show a detailed view of items
+    Usage: show [options] QUERY...
+    Shows every message (the item and its comments) of each
+    matching item, or just some of them with --head, --tail
+    or --range (e.g. "--range 2:5", "--range 10:").  Items
+    are paged in from disk rather than read whole, and what
+    is shown is cached until the item changes.
     """
-    results = []
-    return results
-
-def iter_todos(config, include_done=True):
+    parser = optparse.OptionParser(
+        usage="%prog show [options] QUERY...",
+        )
+    parser.add_option("--head",
+        help="Only the first N messages",
+        metavar="N",
+        dest=OPT_HEAD,
+        action="store",
+        type="int",
+        default=None,
+        )
+    parser.add_option("--tail",
+        help="Only the last N messages",
+        metavar="N",
+        dest=OPT_TAIL,
+        action="store",
+        type="int",
+        default=None,
+        )
+    parser.add_option("--range",
+        help="Only messages FIRST to LAST (counting from 1)",
+        metavar="FIRST:LAST",
+        dest=OPT_RANGE,
+        action="store",
+        default=None,
+        )
+    add_at_option(parser)
+    show_options, terms = parser.parse_args(args)
+    if not terms:
+        return ["Specify a query to select the items to show"]
+    try:
+        selection = message_selection(
+            getattr(show_options, OPT_HEAD),
+            getattr(show_options, OPT_TAIL),
+            getattr(show_options, OPT_RANGE),
+            )
+    except ValueError, e:
+        return [str(e)]
     todo_dir = find_dir_based_on_config(config)
+    rev = getattr(show_options, OPT_AT)
+    if rev is None:
+        query = parse_query(terms, list_categories(todo_dir))
+        matches = [
+            fname
+            for _, _, fname, msg in sorted(scan_todo_dir(todo_dir))
+            if item_matches(fname, query, msg)
+            ]
+        return iter_show(todo_dir, matches, selection)
+    try:
+        vcs = get_vcs(config, todo_dir)
+        items = scan_todo_dir_at(config, todo_dir, rev)
+        query = parse_query(terms, categories_of(items))
+        matches = [
+            fname
+            for _, _, fname, msg in sorted(items)
+            if item_matches(fname, query, msg)
+            ]
+    except (ValueError, NotImplementedError, OSError), e:
+        return ["Can't show revision %r: %s" % (rev, e)]
+    return iter_show_at(vcs, rev, matches, selection)
+
+def message_selection(head, tail, range_):
+    """Turn the --head/--tail/--range options into a function
+    mapping a message count to the slice of messages to show
+    """
+    if range_ is not None:
+        m = re.match(r"^\s*(\d*)\s*:\s*(\d*)\s*$", range_)
+        if not m:
+            raise ValueError("Ranges look like FIRST:LAST, not %r" % range_)
+        first = int(m.group(1) or 1)
+        last = None
+        if m.group(2):
+            last = int(m.group(2))
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(
+                "Ranges need 1 <= FIRST <= LAST, not %r" % range_)
+        return lambda count: slice(first - 1, last)
+    if head is not None:
+        if head < 1:
+            raise ValueError("--head needs at least 1, not %i" % head)
+        return lambda count: slice(0, head)
+    if tail is not None:
+        if tail < 1:
+            raise ValueError("--tail needs at least 1, not %i" % tail)
+        return lambda count: slice(max(count - tail, 0), count)
+    return lambda count: slice(0, count)
+
+def message_offsets(data):
+    """The (start, end) offsets of each message in the mbox
+    'data', which may be a string or an mmap
+    """
+    starts = []
+    if data[:5] == "From ":
+        starts.append(0)
+    pos = data.find("\nFrom ")
+    while pos != -1:
+        starts.append(pos + 1)
+        pos = data.find("\nFrom ", pos + 1)
+    return zip(starts, starts[1:] + [len(data)])
+
+class MessageReader(object):
+    """The lines of data[start:end] (an mmap or a string), one
+    at a time, so no more than a line (or SHOW_CHUNK bytes of
+    a longer one) is ever copied out
+    """
+    def __init__(self, data, start, end):
+        self.data = data
+        self.pos = start
+        self.end = end
+    def peek(self):
+        "The next line without consuming it, or None at the end"
+        if self.pos >= self.end:
+            return None
+        stop = min(self.end, self.pos + SHOW_CHUNK)
+        newline = self.data.find("\n", self.pos, stop)
+        if newline != -1:
+            stop = newline + 1
+        return self.data[self.pos:stop]
+    def next(self):
+        line = self.peek()
+        if line is not None:
+            self.pos += len(line)
+        return line
+    def __iter__(self):
+        while True:
+            line = self.next()
+            if line is None:
+                return
+            yield line
+
+def at_boundary(line, boundaries):
+    "Whether 'line' is a MIME boundary line for any of 'boundaries'"
+    if not line.startswith("--"):
+        return False
+    line = line.rstrip("\r\n")
+    return any(
+        line == "--" + boundary or line == "--" + boundary + "--"
+        for boundary in boundaries
+        )
+
+def skip_part(reader, boundaries):
+    "Skip to the next of 'boundaries' (or the end)"
+    line = reader.peek()
+    while line is not None and not at_boundary(line, boundaries):
+        reader.next()
+        line = reader.peek()
+
+def iter_decoded(reader, encoding, boundaries):
+    "Yield a part's body a line at a time, undoing its transfer encoding"
+    pending = ""
+    line = reader.peek()
+    while line is not None and not at_boundary(line, boundaries):
+        reader.next()
+        following = reader.peek()
+        if following is not None and at_boundary(following, boundaries):
+            # the line break before a boundary belongs to the boundary
+            if line.endswith("\n"):
+                line = line[:-1]
+            if line.endswith("\r"):
+                line = line[:-1]
+        if encoding == "base64":
+            pending += "".join(line.split())
+            usable = len(pending) - len(pending) % 4
+            try:
+                yield base64.b64decode(pending[:usable])
+            except TypeError:
+                pass
+            pending = pending[usable:]
+        elif encoding == "quoted-printable":
+            yield quopri.decodestring(line)
+        else:
+            yield line
+        line = reader.peek()
+
+def iter_text_lines(chunks):
+    "Split the decoded 'chunks' of a text part into lines"
+    carry = ""
+    for chunk in chunks:
+        lines = (carry + chunk).split("\n")
+        carry = lines.pop()
+        if len(carry) > SHOW_CHUNK:
+            lines.append(carry)
+            carry = ""
+        for line in lines:
+            yield line.rstrip("\r")
+    if carry:
+        yield carry.rstrip("\r")
+
+def render_part(msg, reader, boundaries):
+    """The lines showing the body of the MIME part with headers
+    'msg', read from 'reader' up to the next of 'boundaries'
+    """
+    if msg.get_content_maintype() == "multipart" and msg.get_boundary():
+        boundary = msg.get_boundary()
+        inner = boundaries + [boundary]
+        skip_part(reader, inner)
+        line = reader.peek()
+        while line is not None and at_boundary(line, [boundary]):
+            reader.next()
+            if line.rstrip("\r\n").endswith(boundary + "--"):
+                # the epilogue
+                skip_part(reader, boundaries)
+                return
+            for rendered in render_part(
+                    headers_from_lines(reader), reader, inner):
+                yield rendered
+            line = reader.peek()
+        return
+    if msg.get_content_type() == "message/rfc822":
+        for rendered in render_part(
+                headers_from_lines(reader), reader, boundaries):
+            yield rendered
+        return
+    if msg.get_content_maintype() != "text":
+        yield "[%s attachment %s]" % (
+            msg.get_content_type(),
+            msg.get_filename() or "",
+            )
+        skip_part(reader, boundaries)
+        return
+    encoding = msg.get("Content-Transfer-Encoding", "").strip().lower()
+    for line in iter_text_lines(iter_decoded(reader, encoding, boundaries)):
+        # undo the mbox quoting of "From " lines
+        yield line[1:] if line.startswith(">From ") else line
+
+def render_message(data, start, end):
+    """The lines to show for the message at data[start:end]
+    Only the headers are parsed as a whole; bodies are decoded
+    a line at a time straight out of 'data'
+    """
+    reader = MessageReader(data, start, end)
+    msg = headers_from_lines(reader)
+    for header in SHOW_HEADERS:
+        if msg[header]:
+            yield "%s: %s" % (header, msg[header])
+    yield ""
+    for line in render_part(msg, reader, []):
+        yield line
+
+def iter_rendered(data, selection):
+    "Render the selected messages of the mbox in 'data'"
+    offsets = message_offsets(data)
+    chosen = range(len(offsets))[selection(len(offsets))]
+    for number in chosen:
+        start, end = offsets[number]
+        yield "--- %i/%i ---" % (number + 1, len(offsets))
+        for line in render_message(data, start, end):
+            yield line
+
+def iter_show(todo_dir, fnames, selection):
+    """Yield the lines showing each of 'fnames'
+    Each item is mmapped so only the messages being shown get
+    read, and the rendered text is cached against the item's
+    mtime and size
+    """
+    for i, fname in enumerate(fnames):
+        if i:
+            yield ""
+        yield "==> %s <==" % os.path.relpath(fname)
+        for line in iter_show_cached(todo_dir, fname, selection):
+            yield line
+
+def open_show_cache(todo_dir, cache_name):
+    """A temp file to render into before renaming it over
+    'cache_name', or None if the cache can't be written to
+    (e.g. a read-only checkout).  Only the SHOW_CACHE_LIMIT
+    most recently rendered entries are kept
+    """
+    try:
+        make_state_dir(todo_dir)
+        cache_dir = os.path.dirname(cache_name)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.mkdir(cache_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        entries = [
+            os.path.join(cache_dir, name)
+            for name in os.listdir(cache_dir)
+            ]
+        if len(entries) >= SHOW_CACHE_LIMIT:
+            entries.sort(key=mtime_or_none)
+            for entry in entries[:len(entries) - SHOW_CACHE_LIMIT + 1]:
+                try:
+                    os.remove(entry)
+                except OSError:
+                    pass
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=os.path.basename(cache_name), dir=cache_dir)
+    except (IOError, OSError), e:
+        log.warning("Can't cache what is shown: %s", e)
+        return None, None
+    return os.fdopen(fd, "w"), tmp_name
+
+def iter_show_cached(todo_dir, fname, selection):
+    """Yield the lines showing 'fname', from the cache if it
+    was last shown with the same selection and hasn't changed.
+    There is one cache entry per item
+    """
+    st = os.stat(fname)
+    stamp = "%r\t%i\t%s\n" % (
+        st.st_mtime,
+        st.st_size,
+        selection(sys.maxint),
+        )
+    key = hashlib.sha1(os.path.relpath(fname, todo_dir)).hexdigest()
+    cache_name = os.path.join(state_file(todo_dir, SHOW_CACHE_DIRNAME), key)
+    try:
+        f = file(cache_name)
+    except IOError:
+        pass
+    else:
+        try:
+            if f.readline() == stamp:
+                log.debug("Showing %r from the cache", fname)
+                for line in f:
+                    yield line.rstrip("\n")
+                return
+        finally:
+            f.close()
+    cache, tmp_name = open_show_cache(todo_dir, cache_name)
+    def write_cache(text):
+        try:
+            cache.write(text)
+            return True
+        except IOError, e:
+            log.warning("Can't cache what is shown: %s", e)
+            return False
+    try:
+        caching = cache is not None and write_cache(stamp)
+        if st.st_size:
+            f = file(fname, "rb")
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for line in iter_rendered(data, selection):
+                        caching = caching and write_cache(line + "\n")
+                        yield line
+                finally:
+                    data.close()
+            finally:
+                f.close()
+        if caching:
+            try:
+                cache.close()
+                if IS_WINDOWS and os.path.exists(cache_name):
+                    os.remove(cache_name)
+                os.rename(tmp_name, cache_name)
+            except (IOError, OSError), e:
+                log.warning("Can't cache what is shown: %s", e)
+    finally:
+        if cache is not None:
+            cache.close()
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+def iter_show_at(vcs, rev, fnames, selection):
+    "Like iter_show(), but with the items as of revision 'rev'"
+    for i, (fname, content) in enumerate(vcs.iter_contents_at(rev, fnames)):
+        if i:
+            yield ""
+        yield "==> %s@%s <==" % (os.path.relpath(fname), rev)
+        for line in iter_rendered(content, selection):
+            yield line
+
+def iter_todos(config, include_done=True, todo_dir=None):
+    if todo_dir is None:
+        todo_dir = find_dir_based_on_config(config)
     done_dir = config.get(CONF_SEC_CONFIG, CONF_DONE_CATEGORY)
-    for name in os.listdir(todo_dir):
+    for name in list_categories(todo_dir):
         if name == done_dir and not include_done:
             continue
         full_name = os.path.join(todo_dir, name)
-        if not os.path.isdir(full_name): continue
         for fname in glob(os.path.join(full_name, "*mbox")):
             yield os.path.join(full_name, fname)
 
+def do_next(options, config, args):
+    """Claim the most important unclaimed item
+    Usage: next [options]
+    Picks the highest priority, oldest open item that nobody
+    holds a claim on, and claims it for --lease seconds so
+    concurrent workers each get a different item.  Once a
+    claim expires the item is up for grabs again.  The queue
+    is kept up to date by add/edit/close; --reindex rebuilds
+    it after items were changed by other means.
+    """
+    results = []
+    parser = optparse.OptionParser(
+        usage="%prog next [options]",
+        )
+    parser.add_option("-C", "--category",
+        help="Only consider items in this category",
+        dest=OPT_CATEGORY,
+        action="store",
+        default=None,
+        )
+    parser.add_option("-l", "--lease",
+        help="Seconds to hold the claim for (default %default)",
+        dest=OPT_LEASE,
+        action="store",
+        type="int",
+        default=DEF_LEASE_SECONDS,
+        )
+    parser.add_option("-w", "--worker",
+        help="Name to record on the claim (default %default)",
+        dest=OPT_WORKER,
+        action="store",
+        default="%s@%s:%i" % (LOCAL_USER_ID, gethostname(), os.getpid()),
+        )
+    parser.add_option("--reindex",
+        help="Rebuild the queue from the items themselves",
+        dest=OPT_REINDEX,
+        action="store_true",
+        default=False,
+        )
+    parser.add_option("--release",
+        help="Drop the claim on item ID instead",
+        metavar="ID",
+        dest=OPT_RELEASE,
+        action="store",
+        default=None,
+        )
+    next_options, next_args = parser.parse_args(args)
+    todo_dir = find_dir_based_on_config(config)
+    ident = getattr(next_options, OPT_RELEASE)
+    if ident is not None:
+        release_item(todo_dir, item_id(ident))
+        results.append("Released " + item_id(ident))
+        return results
+    category = getattr(next_options, OPT_CATEGORY)
+    if category is not None:
+        names = dict(
+            (clean(name), name)
+            for name in list_categories(todo_dir)
+            )
+        guessed = guess_one_of(clean(category), sorted(names))
+        if guessed is None:
+            results.append("No category %r" % category)
+            return results
+        category = names[guessed]
+    claims_dir = os.path.dirname(claim_file(todo_dir, "-"))
+    claimed = set(os.listdir(claims_dir))
+    for _, relname in load_queue(
+            config, todo_dir, getattr(next_options, OPT_REINDEX)):
+        if category is not None and os.path.dirname(relname) != category:
+            continue
+        ident = item_id(relname)
+        if ident in claimed and not claim_expired(
+                os.path.join(claims_dir, ident)):
+            continue
+        fname = os.path.join(todo_dir, relname)
+        if not os.path.exists(fname):
+            continue
+        if claim_item(
+                todo_dir,
+                ident,
+                getattr(next_options, OPT_WORKER),
+                getattr(next_options, OPT_LEASE),
+                ):
+            results.append(fname)
+            break
+    return results
+
 def do_search(options, config, args):
     """List all/matching items
+    Items are ordered by priority, then by age.  With the
+    global --root/--all-roots options, every root is searched
+    in parallel (up to "jobs" at a time) and the results merged.
+    Usage: search [--at REV] [QUERY...]
     """
     results = []
-    for mbox in iter_todos(config):
+    parser = optparse.OptionParser(
+        usage="%prog search [--at REV] [QUERY...]",
+        )
+    add_at_option(parser)
+    search_options, terms = parser.parse_args(args)
+    rev = getattr(search_options, OPT_AT)
+    roots = find_roots(options, config)
+    if roots is None:
+        roots = [None]
+    elif not roots:
+        results.append("No roots matched")
+        return results
+    try:
+        if len(roots) == 1:
+            per_root = [search_root(config, roots[0], terms, rev=rev)]
+        else:
+            jobs = min(config.getint(CONF_SEC_CONFIG, CONF_JOBS), len(roots))
+            pool = multiprocessing.pool.ThreadPool(max(jobs, 1))
+            try:
+                per_root = pool.map(
+                    lambda root: search_root(config, root, terms, rev=rev,
+                        strict=False),
+                    roots,
+                    )
+            finally:
+                pool.close()
+                pool.join()
+    except (ValueError, NotImplementedError, OSError), e:
+        results.append("Can't search revision %r: %s" % (rev, e))
+        return results
+    for _, mbox in heapq.merge(*per_root):
         results.append(mbox)
     return results
 
+def do_stats(options, config, args):
+    """Show item counts by category, priority, author or week
+    Usage: stats [options] [DIMENSION...]
+    DIMENSION is one or more of category, priority, author,
+    week (when opened) or closed (week when closed).  The
+    counts are kept up to date as items change, so this
+    doesn't need to look at the items themselves.
+    """
+    results = []
+    parser = optparse.OptionParser(
+        usage="%prog stats [options] [DIMENSION...]",
+        )
+    parser.add_option("-f", "--format",
+        help="Output format, one of [%s] (default %%default)" %
+            ", ".join(STATS_FORMATS),
+        dest=OPT_FORMAT,
+        action="callback",
+        type="string",
+        callback=sloppy_choice_callback,
+        callback_args=(STATS_FORMATS, ),
+        default=STATS_FORMATS[0],
+        )
+    parser.add_option("--reindex",
+        help="Recount everything from the items themselves",
+        dest=OPT_REINDEX,
+        action="store_true",
+        default=False,
+        )
+    stats_options, dimensions = parser.parse_args(args)
+    chosen = []
+    for given in dimensions:
+        dimension = guess_one_of(clean(given), STATS_DIMENSIONS)
+        if dimension is None:
+            results.append("No dimension %r" % given)
+            return results
+        chosen.append(dimension)
+    todo_dir = find_dir_based_on_config(config)
+    counters = read_stats(todo_dir, getattr(stats_options, OPT_REINDEX))
+    chosen = chosen or STATS_DIMENSIONS
+    if getattr(stats_options, OPT_FORMAT) == "csv":
+        tmp = StringIO()
+        writer = csv.writer(tmp, lineterminator="\n")
+        writer.writerow(["dimension", "value", "count"])
+        for dimension in chosen:
+            for value, count in sorted(counters.get(dimension, {}).items()):
+                writer.writerow([dimension, value, count])
+        tmp.seek(0)
+        results.extend(line.rstrip("\n") for line in tmp)
+    else:
+        results.append(json.dumps(
+            dict(
+                (dimension, counters.get(dimension, {}))
+                for dimension in chosen
+                ),
+            indent=2,
+            separators=(",", ": "),
+            sort_keys=True,
+            ))
+    return results
+
+def do_complete(options, config, args):
+    """Shell completion support
+    Usage: complete --script=SHELL
+           complete --refresh
+           complete -- WORD...
+    --script prints a bash/zsh completion script, e.g.
+      eval "$(pb complete --script=bash)"
+    which reads a cache of commands, categories, priorities
+    and item IDs without running pb.  The cache is kept up
+    to date as items are added and rebuilt when it goes
+    stale, or with --refresh.
+    """
+    results = []
+    parser = optparse.OptionParser(
+        usage="%prog complete [--script=SHELL | --refresh | -- WORD...]",
+        )
+    parser.add_option("--script",
+        help="Print the completion script for one of [%s]" %
+            ", ".join(COMPLETE_SHELLS),
+        dest=OPT_SCRIPT,
+        action="callback",
+        type="string",
+        callback=sloppy_choice_callback,
+        callback_args=(COMPLETE_SHELLS, ),
+        default=None,
+        )
+    parser.add_option("--refresh",
+        help="Rebuild the completion cache",
+        dest=OPT_REFRESH,
+        action="store_true",
+        default=False,
+        )
+    complete_options, words = parser.parse_args(args)
+    shell = getattr(complete_options, OPT_SCRIPT)
+    if shell is not None:
+        script = COMPLETION_SCRIPT % {
+            "app": APP_NAME,
+            "dirname": config.get(CONF_SEC_CONFIG, CONF_DIRNAME),
+            "state": STATE_DIRNAME,
+            "cache": COMPLETE_CACHE,
+            "complete": CMD_COMPLETE,
+            "help": CMD_HELP,
+            "add": CMD_ADD,
+            "stats": CMD_STATS,
+            "cmd": COMPLETE_CMD,
+            "category": COMPLETE_CATEGORY,
+            "priority": COMPLETE_PRIORITY,
+            "dimension": COMPLETE_DIMENSION,
+            "item": COMPLETE_ITEM,
+            }
+        if shell == "zsh":
+            script = ZSH_COMPLETION_PREFIX + script
+        results.extend(script.splitlines())
+        # shells load this at startup, so it's a good time to
+        # pick up any commands added since the cache was built
+        todo_dir = find_dir_based_on_config(config, create=False)
+        if todo_dir is not None and completions_stale(todo_dir):
+            refresh_completions(todo_dir)
+        return results
+    todo_dir = find_dir_based_on_config(config, create=False)
+    if todo_dir is None:
+        return results
+    cache = state_file(todo_dir, COMPLETE_CACHE)
+    if getattr(complete_options, OPT_REFRESH) or completions_stale(todo_dir):
+        refresh_completions(todo_dir)
+    if not words:
+        return results
+    kinds = completion_kinds(words)
+    cur = words[-1]
+    seen = set()
+    f = file(cache)
+    try:
+        for line in f:
+            kind, _, value = line.rstrip("\n").partition("\t")
+            if kind in kinds and value.startswith(cur) and value not in seen:
+                seen.add(value)
+                results.append(value)
+    finally:
+        f.close()
+    return results
+
+def do_sync(options, config, args):
+    """Stage queued changes with the VCS now
+    Only needed with the "journal" or "background" staging
+    modes, where add/close/edit just queue their files
+    """
+    results = []
+    todo_dir = find_dir_based_on_config(config, create=False)
+    if todo_dir is not None:
+        count = flush_staging(config, todo_dir, wait=True)
+        results.append("Staged %i file(s)" % count)
+    return results
+
 def do_dump_config(options, config, args):
     """Dump the default+existing config to stdout
     """
@@ -661,9 +3268,21 @@ CMDS = [
     (CMD_SHOW, do_show),
     (CMD_LIST, do_search),
     (CMD_SEARCH, do_search),
+    (CMD_NEXT, do_next),
+    (CMD_STATS, do_stats),
+    (CMD_COMPLETE, do_complete),
+    (CMD_SYNC, do_sync),
     (CMD_DUMP_CONFIG, do_dump_config),
     ]
 CMD_MAP = dict(CMDS)
+# commands which shouldn't wait for the staging journal to drain
+STAGING_SKIP_DRAIN = set([
+    do_add,
+    do_close,
+    do_edit,
+    do_complete,
+    do_sync,
+    ])
 
 def options_cmd_rest(args):
     descriptions = []
@@ -690,7 +3309,22 @@ def options_cmd_rest(args):
         dest=OPT_CONFIG,
         action="store",
         )
+    parser.add_option("-R", "--root",
+        help="Search the todo tree of ROOT (a directory or glob) "
+            "instead of the current one; may be repeated",
+        metavar="ROOT",
+        dest=OPT_ROOTS,
+        action="append",
+        )
+    parser.add_option("--all-roots",
+        help="Search every root listed in the [%s] config section" %
+            CONF_SEC_ROOTS,
+        dest=OPT_ALL_ROOTS,
+        action="store_true",
+        )
     parser.set_defaults(**{
+        OPT_ALL_ROOTS: False,
+        OPT_ROOTS: [],
         OPT_VERBOSE: 0,
         OPT_CONFIG: DEFAULT_USER_CONFIG,
         })
@@ -772,6 +3406,12 @@ def tweaking_options(config):
         callback_args=(ALL_PRIORITIES, ),
         default=DEF_PRIORITY_STR,
         )
+    parser.add_option("-b", "--batch",
+        help="Read one summary per line from stdin, adding an item for each",
+        dest=OPT_BATCH,
+        default=False,
+        action="store_true",
+        )
     parser.add_option("-a", "--attach",
         help='Attach a file ("-" for stdin)',
         dest=OPT_ATTACHMENTS,
@@ -814,6 +3454,70 @@ def tweaking_options(config):
         )
     return parser
 
+def add_at_option(parser):
+    "Adds the --at option for looking at an old revision"
+    parser.add_option("--at",
+        help="Look at the items as of revision REV "
+            "(read from the VCS, no checkout needed)",
+        metavar="REV",
+        dest=OPT_AT,
+        action="store",
+        default=None,
+        )
+
+def edit_options(config):
+    """Options for changing the headers of existing items
+    Unlike tweaking_options(), nothing changes by default
+    """
+    parser = optparse.OptionParser(
+        usage="%prog edit [options] QUERY...",
+        )
+    ALL_PRIORITIES = (
+        PRIORITY_NAME_TO_NUMBER.keys() +
+        map(str, PRIORITY_NUMBER_TO_NAME.keys())
+        )
+    parser.add_option("-p", "--priority",
+        help="New priority, one of [%s]" % PRIORITY_STRING,
+        dest=OPT_PRIORITY,
+        action="callback",
+        type="string",
+        callback=sloppy_choice_callback,
+        callback_args=(ALL_PRIORITIES, ),
+        default=None,
+        )
+    parser.add_option("-m", "--email",
+        help="New email address of the submitter",
+        dest=OPT_EMAIL,
+        action="store",
+        default=None,
+        )
+    parser.add_option("-u", "--user",
+        help="New name of the submitter",
+        dest=OPT_USERNAME,
+        action="store",
+        default=None,
+        )
+    parser.add_option("-r", "--revision",
+        help='New revision number ("" to remove it)',
+        dest=OPT_REVISION,
+        action="store",
+        default=None,
+        )
+    parser.add_option("-C", "--category",
+        help="Move the items into this category",
+        dest=OPT_CATEGORY,
+        action="store",
+        default=None,
+        )
+    parser.add_option("-H", "--header",
+        help='Set a header ("Name: value", empty value removes it)',
+        dest=OPT_HEADERS,
+        metavar="HEADER",
+        action="append",
+        default=[],
+        )
+    return parser
+
 def get_default_config():
     try:
         # sort them if we can
@@ -835,6 +3539,8 @@ def get_default_config():
             (CONF_DIRNAME, DEF_DIRNAME),
             (CONF_DONE_CATEGORY, DEF_DONE_CATEGORY),
             (CONF_VCS, DEF_VCS),
+            (CONF_JOBS, str(DEF_JOBS)),
+            (CONF_STAGING, DEF_STAGING),
             ):
         c.set(CONF_SEC_CONFIG, name, value)
     return c
@@ -855,6 +3561,155 @@ def increase_verbosity(cur_level, levels):
 def config_sanity_check(config):
     pass
 
+def mtime_or_none(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def discovery_key(options):
+    return "%s\0%s" % (os.getcwd(), os.path.abspath(options.config))
+
+def discovery_valid(snapshot):
+    """Check that nothing a snapshot was based on has changed
+    Adding/removing a todo or VCS directory anywhere between
+    the current directory and the root changes the mtime of
+    the directory it was added to or removed from
+    """
+    for path, mtime in snapshot["mtimes"].iteritems():
+        if mtime_or_none(path) != mtime:
+            log.debug("%s changed, rediscovering", path)
+            return False
+    return True
+
+def valid_discovery(snapshots):
+    "Check the shape of the discovery snapshots: {key: snapshot}"
+    return isinstance(snapshots, dict) and all(
+        isinstance(snapshot, dict)
+        and is_number(snapshot.get("written"))
+        and isinstance(snapshot.get("mtimes"), dict)
+        and all(
+            mtime is None or is_number(mtime)
+            for mtime in snapshot["mtimes"].itervalues()
+            )
+        and isinstance(snapshot.get("found"), list)
+        and all(
+            isinstance(entry, list) and len(entry) == 3
+            for entry in snapshot["found"]
+            )
+        and isinstance(snapshot.get("config"), list)
+        and all(
+            isinstance(entry, list)
+            and len(entry) == 2
+            and isinstance(entry[1], list)
+            and all(
+                isinstance(item, list) and len(item) == 2
+                for item in entry[1]
+                )
+            for entry in snapshot["config"]
+            )
+        for snapshot in snapshots.itervalues()
+        )
+
+def read_repo_config(config, repo_config):
+    """Layer the REPO_CONFIG_KEYS settings from 'repo_config'
+    onto 'config'.  It comes with the tree, so anything else
+    in it (the editor, who you are, ...) is ignored
+    """
+    repo = ConfigParser.RawConfigParser()
+    repo.read([repo_config])
+    if not repo.has_section(CONF_SEC_CONFIG):
+        return
+    for name in repo.options(CONF_SEC_CONFIG):
+        if name in REPO_CONFIG_KEYS:
+            config.set(CONF_SEC_CONFIG, name, repo.get(CONF_SEC_CONFIG, name))
+        else:
+            log.warning("Ignoring %r in %s", name, repo_config)
+
+def apply_layers(config, layers):
+    "Set the [section, [[name, value], ...]] 'layers' in 'config'"
+    for section, items in layers:
+        if not config.has_section(section):
+            config.add_section(section)
+        for name, value in items:
+            config.set(section, name, value)
+
+def load_config(options):
+    """Build the layered config (defaults, system, user and the
+    REPO_CONFIG_KEYS from the repo-local REPO_CONFIG next to
+    the todo directory), locating the todo and VCS directories
+    on the way.  What the config files set and what was found
+    is kept in a snapshot which is reused while the config files
+    and the directories from here up to the root are unchanged.
+    The defaults come from the environment, so they're rebuilt
+    every time rather than kept in the snapshot
+    """
+    config = get_default_config()
+    key = discovery_key(options)
+    snapshots = load_cache(DISCOVERY_CACHE, {}, valid_discovery)
+    snapshot = snapshots.get(key)
+    if snapshot is not None and discovery_valid(snapshot):
+        log.debug("Using discovery snapshot for %r", key)
+        apply_layers(config, snapshot["config"])
+        for start, name, result in snapshot["found"]:
+            FIND_DIR_CACHE[(start, name)] = result
+        return config
+
+    cwd = os.getcwd()
+    ini_files = [DEFAULT_SYSTEM_CONFIG, options.config]
+    files = ConfigParser.RawConfigParser()
+    files.read(ini_files)
+    if not files.has_section(CONF_SEC_CONFIG):
+        files.add_section(CONF_SEC_CONFIG)
+    dirname = DEF_DIRNAME
+    if files.has_option(CONF_SEC_CONFIG, CONF_DIRNAME):
+        dirname = files.get(CONF_SEC_CONFIG, CONF_DIRNAME)
+    found = {}
+    for name in [dirname] + VCS_DIRNAMES:
+        found[(cwd, name)] = find_dir(name, start=cwd)
+    todo_dir = found[(cwd, dirname)]
+    if todo_dir is not None:
+        repo_config = os.path.join(os.path.dirname(todo_dir), REPO_CONFIG)
+        ini_files.append(repo_config)
+        read_repo_config(files, repo_config)
+    FIND_DIR_CACHE.update(found)
+    layers = [
+        (section, files.items(section))
+        for section in files.sections()
+        ]
+    apply_layers(config, layers)
+
+    mtimes = dict((fname, mtime_or_none(fname)) for fname in ini_files)
+    loc = cwd
+    while True:
+        mtimes[loc] = mtime_or_none(loc)
+        loc, last = os.path.split(loc)[0], loc
+        if loc == last:
+            break
+    snapshots[key] = {
+        "written": time.time(),
+        "mtimes": mtimes,
+        "found": [
+            [start, name, result]
+            for (start, name), result in found.iteritems()
+            ],
+        "config": layers,
+        }
+    if len(snapshots) > DISCOVERY_LIMIT:
+        oldest = sorted(
+            snapshots,
+            key=lambda key: snapshots[key]["written"],
+            )
+        for old_key in oldest[:len(snapshots) - DISCOVERY_LIMIT]:
+            del snapshots[old_key]
+    try:
+        if not os.path.isdir(DEFAULT_USER_DIR):
+            os.makedirs(DEFAULT_USER_DIR)
+        save_cache(DISCOVERY_CACHE, snapshots)
+    except (IOError, OSError), e:
+        log.warning("Can't save discovery snapshot: %s", e)
+    return config
+
 def main(*args):
     parser, options, cmd, rest = options_cmd_rest(list(args[1:]))
     new_verbosity = increase_verbosity(
@@ -863,11 +3718,7 @@ def main(*args):
         )
     log.setLevel(new_verbosity)
     log.info("New logging level: %s", logging.getLevelName(new_verbosity))
-    config = get_default_config()
-    config.read([
-        os.path.join(DEFAULT_SYSTEM_CONFIG),
-        options.config,
-        ])
+    config = load_config(options)
     config_sanity_check(config)
     if cmd is None:
         parser.print_help()
@@ -884,6 +3735,13 @@ def main(*args):
     results = CMD_MAP[cmd](options, config, rest)
     for result in results:
         print str(result)
+    if (staging_mode(config) == STAGING_JOURNAL
+            and CMD_MAP[cmd] not in STAGING_SKIP_DRAIN):
+        # drain whatever earlier invocations queued
+        todo_dir = find_dir_based_on_config(config, create=False)
+        if todo_dir is not None:
+            sys.stdout.flush()
+            flush_staging(config, todo_dir)
 
 if __name__ == "__main__":
     sys.exit(main(*sys.argv))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Stress test: many concurrent "pb add" processes in one checkout
+Every process must get its own item, whole and under its own
+name, with no temp files left behind.  pb.py itself needs
+Python 2, so set PB_PYTHON if "python2" isn't it.
+Run with: python test_add_stress.py
+"""
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+PB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pb.py")
+PYTHON = os.environ.get("PB_PYTHON", "python2")
+WRITERS = 40
+ITEMS_PER_WRITER = 3
+
+class ConcurrentAddTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="pb-stress-")
+        os.makedirs(os.path.join(self.root, "todo", "bugs"))
+        self.env = dict(os.environ, HOME=self.root, EMAIL="ci@example.com")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_concurrent_adds(self):
+        procs = []
+        for writer in range(WRITERS):
+            args = [PYTHON, PB, "add", "--batch", "bugs"]
+            items = "".join(
+                "same subject %i\n" % item
+                for item in range(ITEMS_PER_WRITER)
+                )
+            proc = subprocess.Popen(
+                args,
+                cwd=self.root,
+                env=self.env,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                )
+            procs.append((proc, items))
+        for proc, items in procs:
+            output, errors = proc.communicate(items.encode("ascii"))
+            self.assertEqual(proc.returncode, 0, errors)
+        bugs_dir = os.path.join(self.root, "todo", "bugs")
+        items = glob.glob(os.path.join(bugs_dir, "*.mbox"))
+        self.assertEqual(len(items), WRITERS * ITEMS_PER_WRITER)
+        self.assertEqual(glob.glob(os.path.join(bugs_dir, ".pb-*")), [])
+        for fname in items:
+            f = open(fname, "rb")
+            try:
+                content = f.read()
+            finally:
+                f.close()
+            self.assertTrue(content.startswith(b"From "), fname)
+            self.assertEqual(content.count(b"\nSubject: same subject "), 1)
+            os.remove(fname)
+
+if __name__ == "__main__":
+    unittest.main()